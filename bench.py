@@ -0,0 +1,384 @@
+"""
+Micro-benchmarks for the simulator.  Run with:
+
+    python bench.py [name ...]
+
+With no arguments every benchmark is run.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import random
+import sys
+import time
+
+import json
+
+import block
+from block import blockWork
+from block_index import BlockIndex
+import blockchain
+from client import Client
+import codec
+from difficulty import Difficulty
+import fake_net
+from ledger import Ledger
+from mining import ProofSearch
+import transaction
+import utils
+
+# Target that no hash will meet, so every attempt is counted.
+IMPOSSIBLE_TARGET = 0
+
+
+def report(label, count, seconds, unit='ops'):
+    print(f"{label:<40} {count / seconds:>14,.0f} {unit}/s")
+
+
+def benchFindProof(rounds=200000, accounts=10000):
+    """
+    Hashes per second of the proof search for a block holding a large
+    ledger, before (re-serializing the header per attempt) and after
+    (midstate copy plus nonce bytes).
+    """
+    b = block.Block("8e7912")
+    b.balances = {str(i): i for i in range(accounts)}
+    b.target = IMPOSSIBLE_TARGET
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        b.hasValidProof()
+        b.proof += 1
+    report("findProof, header per attempt", rounds, time.perf_counter() - start, 'hashes')
+
+    header = b.header
+    search = ProofSearch(header.prefix(), header.target)
+    start = time.perf_counter()
+    search.search(0, rounds)
+    report("findProof, midstate search", search.hashes, time.perf_counter() - start, 'hashes')
+
+
+def makeSignedTransactions(count, senders=10):
+    """
+    Builds count signed transactions, spread over a few senders with
+    consecutive nonces, plus the balances needed to accept them.
+    """
+    keyPairs = [utils.generateKeypair() for _ in range(senders)]
+    addresses = [utils.calcAddress(kp['public'].decode()) for kp in keyPairs]
+    txs = []
+    for i in range(count):
+        sender = i % senders
+        tx = transaction.Transaction(addresses[sender], i // senders, keyPairs[sender]['public'],
+                                     outputs=[{'amount': 1, 'address': addresses[(sender + 1) % senders]}], fee=0)
+        tx.sign(keyPairs[sender]['private'])
+        txs.append(tx)
+    balances = {address: count for address in addresses}
+    return txs, balances
+
+
+def benchVerifyBlock(sizes=(100, 1000, 10000)):
+    """
+    Validation latency of a received block, verifying signatures serially
+    versus on a process pool before the sequential state checks.
+    """
+    with ProcessPoolExecutor() as executor:
+        for size in sizes:
+            txs, balances = makeSignedTransactions(size)
+            prevBlock = block.Block("8e7912")
+            prevBlock.balances = balances
+            b = block.Block("8e7912", prevBlock)
+            b.transactions = {tx.id: tx for tx in txs}
+
+            for label, pool in (("serial", None), ("parallel", executor)):
+                transaction.verified_signatures.clear()
+                start = time.perf_counter()
+                assert b.rerun(prevBlock, executor=pool)
+                elapsed = time.perf_counter() - start
+                print(f"verify block, {size:>5} txs, {label:<8} {elapsed * 1000:>10.1f} ms")
+
+
+class NullClient:
+    def __init__(self, address):
+        self.address = address
+
+    def emit(self, msg, o):
+        pass
+
+
+def makeBlockWithTransactions(count):
+    """
+    Builds a block holding count (unsigned) transactions, for benchmarks that
+    only serialize or relay blocks.
+    """
+    b = block.Block("8e7912")
+    for i in range(count):
+        tx = transaction.Transaction(f"{i % 16:064x}", i // 16, b"-----BEGIN PUBLIC KEY-----" + bytes(160),
+                                     sig=bytes(128), outputs=[{'amount': 1, 'address': f"{i:064x}"}], fee=1)
+        b.appendTransaction(tx)
+    return b
+
+
+def benchBroadcast(clientCounts=(10, 100, 1000), txCount=100):
+    """
+    Cost of a PROOF_FOUND broadcast, re-serializing the block per recipient
+    (as send_message does) versus serializing it once.
+    """
+    payload = makeBlockWithTransactions(txCount)
+    for count in clientCounts:
+        for label, shared in (("per recipient", None), ("serialize once", False), ("shared view", True)):
+            scheduler = fake_net.MessageScheduler(virtual_time=True)
+            net = fake_net.FakeNet(scheduler=scheduler, share_payloads=bool(shared))
+            net.register(*[NullClient(i) for i in range(count)])
+            start = time.perf_counter()
+            if shared is None:
+                for address in net.clients:
+                    net.send_message(address, "PROOF_FOUND", payload)
+            else:
+                net.broadcast("PROOF_FOUND", payload)
+            scheduler.run()
+            elapsed = time.perf_counter() - start
+            print(f"broadcast to {count:>4} clients, {label:<15} {elapsed * 1000:>10.1f} ms")
+
+
+def benchReorg(depths=(1, 10, 100), accounts=100000, txsPerBlock=10):
+    """
+    Cost of switching to a competing fork of the given depth, rebuilding
+    state with a full copy of the balances per block (as Block.rerun does)
+    versus rolling a single ledger back and forward with undo logs.
+    """
+    genesis = block.Block()
+    genesis.balances = {f"{i:064x}": 1000 for i in range(accounts)}
+    senders = list(genesis.balances)[:txsPerBlock]
+    blocks = {genesis.id: genesis}
+    index = BlockIndex()
+    index.add(genesis.id, None, 0)
+
+    def extend(prev, depth, recipient):
+        branch = []
+        for _ in range(depth):
+            b = block.Block(recipient, prev)
+            for sender in senders:
+                nonce = b.nextNonce.get(sender, 0)
+                tx = transaction.Transaction(sender, nonce, b"", outputs=[{'amount': 1, 'address': recipient}])
+                b.appendTransaction(tx)
+                b.nextNonce[sender] = nonce + 1
+            blocks[b.id] = b
+            index.add(b.id, b.prevBlockHash, b.chainLength)
+            branch.append(b)
+            prev = b
+        return branch
+
+    for depth in depths:
+        oldBranch = extend(genesis, depth, f"{accounts:064x}")
+        newBranch = extend(genesis, depth + 1, f"{accounts + 1:064x}")
+
+        start = time.perf_counter()
+        balances, nonces = genesis.balances, {}
+        for b in newBranch:
+            balances, nonces = dict(balances), dict(nonces)
+            for tx in b.transactions.values():
+                nonces[tx.from_address] = tx.nonce + 1
+                balances[tx.from_address] -= tx.total_output()
+                for output in tx.outputs:
+                    balances[output['address']] = balances.get(output['address'], 0) + output['amount']
+        rebuild = time.perf_counter() - start
+
+        ledger = Ledger(genesis)
+        prev = genesis
+        for b in oldBranch:
+            ledger.apply(b, prev)
+            prev = b
+        start = time.perf_counter()
+        assert ledger.reorg(newBranch[-1].id, blocks, index)
+        undo = time.perf_counter() - start
+
+        print(f"reorg, fork depth {depth:>3}, copy and rerun {rebuild * 1000:>9.2f} ms, "
+              f"undo log {undo * 1000:>9.2f} ms")
+
+
+def benchCodec(txCount=100, rounds=200):
+    """
+    Payload size and encode/decode speed of a block in the JSON form sent
+    over FakeNet versus the binary codec.
+    """
+    kp = utils.generateKeypair()
+    b = block.Block(f"{1:064x}")
+    for i in range(txCount):
+        tx = transaction.Transaction(f"{2:064x}", i, kp['public'], sig=bytes(128),
+                                     outputs=[{'amount': 1, 'address': f"{i:064x}"}], fee=1)
+        b.appendTransaction(tx)
+
+    jsonForm = fake_net.encode_payload(b)
+    binaryForm = codec.encodeBlock(b)
+    print(f"block with {txCount} txs: JSON {len(jsonForm):,} bytes, binary {len(binaryForm):,} bytes "
+          f"({len(jsonForm) / len(binaryForm):.1f}x smaller)")
+
+    for label, encode, decode, data in (
+            ("JSON", fake_net.encode_payload, lambda buf: block.Block.deserialize(json.loads(buf)), jsonForm),
+            ("binary", codec.encodeBlock, codec.decodeBlock, binaryForm)):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            encode(b)
+        report(f"encode block, {label}", rounds, time.perf_counter() - start, 'blocks')
+        start = time.perf_counter()
+        for _ in range(rounds):
+            decode(data)
+        report(f"decode block, {label}", rounds, time.perf_counter() - start, 'blocks')
+
+
+def benchGossip(nodeCounts=(100, 500), fanout=8, txCount=100, messageDelay=100, loss=0.01):
+    """
+    Traffic and propagation of one block over a gossip network where each
+    node links to fanout random peers, compared with a flood in which every
+    node rebroadcasts the block to every other node.
+    """
+    payload = codec.encodeBlock(makeBlockWithTransactions(txCount))
+    for count in nodeCounts:
+        scheduler = fake_net.MessageScheduler(virtual_time=True)
+        net = fake_net.FakeNet(chance_message_fails=loss, message_delay=messageDelay, scheduler=scheduler,
+                               seed=0, fanout=fanout)
+        net.register(*[NullClient(i) for i in range(count)])
+        start = time.perf_counter()
+        messageId = net.broadcast("PROOF_FOUND", payload, sender=0)
+        scheduler.run()
+        stats = net.stats[messageId].summary()
+        elapsed = time.perf_counter() - start
+        flood = count * (count - 1)
+        print(f"gossip to {count:>4} nodes, fanout {fanout}: {stats['messages']:>6} messages "
+              f"({stats['bytes'] / 1e6:.1f} MB), flood {flood:>7} messages ({flood * len(payload) / 1e6:.1f} MB); "
+              f"reached {stats['reached']}/{count - 1}, 50/90/100% in "
+              f"{stats['p50']}/{stats['p90']}/{stats['p100']} ms; {elapsed * 1000:.1f} ms to simulate")
+
+
+def benchCompactBlocks(txCount=2000, missingFractions=(0, 0.01, 0.1), poolSize=10000, rounds=20,
+                       hopDelay=50, bandwidth=1e6):
+    """
+    Bytes sent and receiver time to relay a block as a full encoding versus
+    a compact block rebuilt from a mempool, with a round trip for missing
+    transactions.  Latency assumes hopDelay ms per message plus transfer
+    time at bandwidth bytes per second.
+    """
+    b = makeBlockWithTransactions(txCount)
+    txs = list(b.transactions.values())
+    extra = list(makeBlockWithTransactions(poolSize).transactions.values())[txCount:]
+    full = codec.encodeBlock(b)
+    compact = codec.encodeCompactBlock(b)
+
+    def latency(size, hops):
+        return hops * hopDelay + size / bandwidth * 1000
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        codec.decodeBlock(full)
+    elapsed = (time.perf_counter() - start) / rounds
+    print(f"block of {txCount} txs, full:       {len(full):>10,} bytes, {latency(len(full), 1):>7.1f} ms latency, "
+          f"{elapsed * 1000:>7.1f} ms to decode")
+
+    for fraction in missingFractions:
+        missing = set(range(0, txCount, round(1 / fraction))) if fraction else set()
+        pool = [tx for i, tx in enumerate(txs) if i not in missing] + extra
+        txn = codec.encodeBlockTxn(b.id, [txs[i] for i in sorted(missing)])
+        size = len(compact) + (len(txn) + len(json.dumps(sorted(missing))) if missing else 0)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            view = codec.CompactBlock(compact)
+            found, indexes = view.match(pool)
+            if indexes:
+                _, received = codec.decodeBlockTxn(txn)
+                received = iter(received)
+                found = [tx if tx is not None else next(received) for tx in found]
+            view.toBlock(found)
+        elapsed = (time.perf_counter() - start) / rounds
+        print(f"block of {txCount} txs, compact, {fraction:>4.0%} missing: {size:>10,} bytes, "
+              f"{latency(size, 3 if missing else 1):>7.1f} ms latency, {elapsed * 1000:>7.1f} ms to rebuild")
+
+
+def benchRetarget(windows=8, powerSteps=(1, 4, 16), seed=0):
+    """
+    Average block interval per retarget window on a virtual clock, as the
+    hash rate grows in steps.  Blocks are not actually mined: the time to
+    find each one is drawn from the exponential distribution its target
+    implies.
+    """
+    d = Difficulty()
+    baseRate = blockWork(2 ** 240) / d.blockTime
+    rng = random.Random(seed)
+    for retarget in (False, True):
+        now = 0.0
+        utils.setClock(lambda: now / 1000)
+        genesis = block.Block(f"{0:064x}", target=2 ** 240)
+        blocks = {genesis.id: genesis}
+        index = BlockIndex()
+        index.add(genesis.id, None, 0)
+        prev = genesis
+        intervals = []
+        for power in powerSteps:
+            for _ in range(windows * d.interval // len(powerSteps)):
+                target = d.nextTarget(prev.id, blocks, index) if retarget else prev.target
+                now += rng.expovariate(power * baseRate / blockWork(target))
+                b = block.Block(f"{0:064x}", prev, target=target)
+                blocks[b.id] = b
+                index.add(b.id, b.prevBlockHash, b.chainLength)
+                prev = b
+            window = [blocks[index.ancestorAtHeight(prev.id, h)].timestamp
+                      for h in (prev.chainLength - d.interval, prev.chainLength)]
+            intervals.append(f"{power:>3}x: {(window[1] - window[0]) / d.interval:>6.0f} ms")
+        utils.setClock()
+        print(f"block interval, {'retargeting' if retarget else 'fixed target'}: {', '.join(intervals)}")
+
+
+def syncClient(name, net, genesis):
+    """
+    A client with a placeholder key, registered with the network.
+    """
+    c = Client(name=name, net=net, startingBlock=genesis, keyPair={'public': name, 'private': None})
+    net.register(c)
+    return c
+
+
+def benchSync(lengths=(1000, 10000), peerCount=3, messageDelay=100):
+    """
+    Catch-up of a node that only has the genesis block, syncing headers
+    first from a few peers over a simulated network.  Fetching the chain
+    one round trip at a time would need a request and a
+    response per block.
+    """
+    for length in lengths:
+        chain = [block.Block(f"{0:064x}")]
+        # Far enough back that the last block is not in the future.
+        chain[0].timestamp -= length * blockchain.TARGET_BLOCK_TIME
+        for _ in range(length):
+            b = block.Block(f"{0:064x}", chain[-1])
+            b.timestamp = chain[-1].timestamp + blockchain.TARGET_BLOCK_TIME
+            chain.append(b)
+        scheduler = fake_net.MessageScheduler(virtual_time=True)
+        net = fake_net.FakeNet(message_delay=messageDelay, scheduler=scheduler, seed=0)
+        peers = [syncClient(f"Peer{i}", net, chain[0]) for i in range(peerCount)]
+        for peer in peers:
+            for b in chain[1:]:
+                peer.receiveBlock(b)
+        late = syncClient("Late", net, chain[0])
+
+        start = time.perf_counter()
+        late.startSync([peer.address for peer in peers])
+        messages = scheduler.run()
+        elapsed = time.perf_counter() - start
+        assert late.lastBlock.id == chain[-1].id
+        print(f"sync {length:>6} blocks from {peerCount} peers: {elapsed * 1000:>9.1f} ms, "
+              f"{messages} messages (vs {2 * length} one at a time), "
+              f"{scheduler.now()} ms simulated")
+
+
+BENCHMARKS = {
+    'findProof': benchFindProof,
+    'verifyBlock': benchVerifyBlock,
+    'broadcast': benchBroadcast,
+    'reorg': benchReorg,
+    'codec': benchCodec,
+    'sync': benchSync,
+    'gossip': benchGossip,
+    'compactBlocks': benchCompactBlocks,
+    'retarget': benchRetarget,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -1,22 +1,109 @@
+from collections.abc import Mapping
+import hashlib
 import json
+import struct
 
-import utils
-import time
+from ledger import LedgerState
+import merkle
 import transaction
+import utils
 
 POW_BASE_TARGET = 0xffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff
 COINBASE_AMT_ALLOWED = 25
 
+# Fixed-size header layout: prevBlockHash, transactions Merkle root, timestamp,
+# target, rewardAddr and proof.  The proof is deliberately the last field, so
+# everything before it is a constant prefix while searching for a proof.
+HEADER_FORMAT = struct.Struct('>32s32sQ32s32sQ')
+HEADER_SIZE = HEADER_FORMAT.size
+PROOF_OFFSET = HEADER_SIZE - 8
+
+ZERO_HASH = bytes(32)
+
+
+def fixed32(value) -> bytes:
+    """
+    Encodes a hash or address as exactly 32 bytes for the block header.
+    Hex digests are stored raw; anything else is committed to by its hash.
+    """
+    if value is None:
+        return ZERO_HASH
+    if isinstance(value, bytes):
+        return value if len(value) == 32 else hashlib.sha256(value).digest()
+    if len(value) == 64:
+        try:
+            return bytes.fromhex(value)
+        except ValueError:
+            pass
+    return hashlib.sha256(str(value).encode()).digest()
+
+
+def blockWork(target) -> int:
+    """
+    Expected number of hashes needed to find a proof below target.
+    """
+    return 2 ** 256 // (target + 1)
+
+
+class BlockHeader:
+    """
+    The part of a block covered by the proof-of-work.  Its size does not
+    depend on the number of accounts or transactions, so hashing it costs
+    the same however large the ledger gets.
+    """
+
+    def __init__(self, prevBlockHash, txRoot, timestamp, target, rewardAddr, proof=0):
+        self.prevBlockHash = fixed32(prevBlockHash)
+        self.txRoot = fixed32(txRoot)
+        self.timestamp = timestamp
+        self.target = target
+        self.rewardAddr = fixed32(rewardAddr)
+        self.proof = proof
+
+    def prefix(self) -> bytes:
+        """
+        The serialized header without the proof.
+        """
+        return self.serialize()[:PROOF_OFFSET]
+
+    def serialize(self) -> bytes:
+        return HEADER_FORMAT.pack(self.prevBlockHash, self.txRoot, self.timestamp,
+                                  self.target.to_bytes(32, 'big'), self.rewardAddr, self.proof)
+
+    @staticmethod
+    def deserialize(buf):
+        prev, txRoot, timestamp, target, rewardAddr, proof = HEADER_FORMAT.unpack_from(buf)
+        return BlockHeader(prev, txRoot, timestamp, int.from_bytes(target, 'big'), rewardAddr, proof)
+
+    def digest(self) -> bytes:
+        return hashlib.sha256(self.serialize()).digest()
+
+    def hashVal(self) -> str:
+        return self.digest().hex()
+
+    def hasValidProof(self) -> bool:
+        return int.from_bytes(self.digest(), 'big') < self.target
+
 class Block:
     def __init__(self, rewardAddr = None, prevBlock=None, target=POW_BASE_TARGET,
-                 coinbaseReward=COINBASE_AMT_ALLOWED):
+                 coinbaseReward=COINBASE_AMT_ALLOWED, balances=None, nextNonce=None):
+        """
+        :param balances: balances after prevBlock, if not prevBlock's own,
+            e.g. a client's ledger for a block read back from a block store.
+        :param nextNonce: nonces after prevBlock, likewise.
+        """
         self.prevBlockHash = prevBlock.hashVal() if prevBlock else None
         self.target = target
 
         # Get the balances and nonces from the previous block, if available.
         # Note that balances and nonces are NOT part of the serialized format.
-        self.balances = prevBlock.balances.copy() if prevBlock else {}
-        self.nextNonce = prevBlock.nextNonce.copy() if prevBlock else {}
+        # They are layered over the previous block's state rather than copied.
+        if prevBlock and balances is None:
+            balances = prevBlock.balances
+        if prevBlock and nextNonce is None:
+            nextNonce = prevBlock.nextNonce
+        self.balances = LedgerState(balances)
+        self.nextNonce = LedgerState(nextNonce)
 
         if prevBlock and prevBlock.rewardAddr:
             # Add the previous block's rewards to the miner who found the proof.
@@ -26,13 +113,12 @@ class Block:
         # Storing transactions in an OrderedDict to preserve key order.
         self.transactions = {}
 
-        # Used to determine the winner between competing chains.
-        # Note that this is a little simplistic -- an attacker
-        # could make a long, but low-work chain.  However, this works
-        # well enough for us.
+        # Merkle tree over the transaction ids, committed to by the header.
+        self.txTree = merkle.MerkleTree()
+
         self.chainLength = prevBlock.chainLength + 1 if prevBlock else 0
 
-        self.timestamp = int(time.time() * 1000)
+        self.timestamp = int(utils.now() * 1000)
 
         # The address that will gain both the coinbase reward and transaction fees,
         # assuming that the block is accepted by the network.
@@ -40,33 +126,78 @@ class Block:
 
         self.coinbaseReward = coinbaseReward
 
+        self.proof = 0
+
     def isGenesisBlock(self):
         return self.chainLength == 0
 
     def hasValidProof(self):
-        h = utils.hashe(self.serialize())
-        n = int(h, 16)
-        return n < self.target
+        return self.header.hasValidProof()
+
+    def txRoot(self) -> bytes:
+        """
+        Merkle root of the ordered list of transaction ids.
+        """
+        return self.txTree.root()
+
+    def inclusionProof(self, txId: str):
+        """
+        Proves that a transaction is in this block without revealing the
+        rest of the block.  Returns None if the transaction is not included.
+        """
+        return self.txTree.proof(bytes.fromhex(txId))
+
+    @staticmethod
+    def verifyInclusion(txId: str, proof, txRoot: bytes) -> bool:
+        """
+        Checks an inclusion proof against the transactions root of a header.
+        """
+        return merkle.verifyProof(bytes.fromhex(txId), proof, txRoot)
+
+    @property
+    def header(self) -> BlockHeader:
+        return BlockHeader(self.prevBlockHash, self.txRoot(), self.timestamp,
+                           self.target, self.rewardAddr, self.proof)
 
     def serialize(self):
-        return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True)
+        return json.dumps(self.toJSON(), default=lambda o: o.toJSON() if hasattr(o, 'toJSON') else o.__dict__,
+                          sort_keys=True)
 
     def toJSON(self):
         return {
             'chainLength': self.chainLength,
             'prevBlockHash': self.prevBlockHash,
             'target': self.target,
-            'balances': self.balances,
-            'nextNonce': self.nextNonce,
+            'balances': dict(self.balances),
+            'nextNonce': dict(self.nextNonce),
             'transactions': self.transactions,
             'chainLength': self.chainLength,
             'timestamp': self.timestamp,
             'rewardAddr': self.rewardAddr,
             'coinbaseReward': self.coinbaseReward,
+            'proof': self.proof,
         }
 
+    @staticmethod
+    def deserialize(o):
+        """
+        Rebuilds a block from its JSON form.  Balances and nonces are not
+        restored; they are recomputed when the block is connected.
+        """
+        b = Block(o['rewardAddr'], target=o['target'], coinbaseReward=o['coinbaseReward'])
+        b.prevBlockHash = o['prevBlockHash']
+        b.chainLength = o['chainLength']
+        b.timestamp = o['timestamp']
+        b.proof = o['proof']
+        txs = o['transactions']
+        for t in (txs.values() if isinstance(txs, Mapping) else txs):
+            tx = transaction.Transaction.deserialize(t)
+            b.transactions[tx.id] = tx
+        b.txTree.extend(bytes.fromhex(txId) for txId in b.transactions)
+        return b
+
     def hashVal(self):
-        return utils.hashe(self.serialize())
+        return self.header.hashVal()
 
     @property
     def id(self):
@@ -81,16 +212,16 @@ class Block:
             if client:
                 client.log(f"Unsigned transaction {tx.id}.")
             return False
-        elif not tx.validSignature():
+        elif not tx.valid_signature():
             if client:
                 client.log(f"Invalid signature for transaction {tx.id}.")
             return False
-        elif not tx.sufficientFunds(self):
+        elif not tx.sufficient_funds(self):
             if client:
                 client.log(f"Insufficient gold for transaction {tx.id}.")
             return False
 
-        nonce = self.nextNonce.get(tx.from_, 0)
+        nonce = self.nextNonce.get(tx.from_address, 0)
         if tx.nonce < nonce:
             if client:
                 client.log(f"Replayed transaction {tx.id}.")
@@ -100,23 +231,44 @@ class Block:
                 client.log(f"Out of order transaction {tx.id}.")
             return False
         else:
-            self.nextNonce[tx.from_] = nonce + 1
+            self.nextNonce[tx.from_address] = nonce + 1
 
-        self.transactions[tx.id] = tx
+        self.appendTransaction(tx)
 
-        sender_balance = self.balanceOf(tx.from_)
-        self.balances[tx.from_] = sender_balance - tx.totalOutput()
+        sender_balance = self.balanceOf(tx.from_address)
+        self.balances[tx.from_address] = sender_balance - tx.total_output()
 
         for output in tx.outputs:
-            amount, address = output
-            old_balance = self.balanceOf(address)
-            self.balances[address] = amount + old_balance
+            old_balance = self.balanceOf(output['address'])
+            self.balances[output['address']] = output['amount'] + old_balance
+
+        return True
+
+    def appendTransaction(self, tx: transaction.Transaction):
+        """
+        Appends a transaction and commits to it in the Merkle tree, without
+        any of the checks of addTransaction or any change to balances.  For
+        transactions that were already validated, or for building an invalid
+        block on purpose.
+        """
+        self.transactions[tx.id] = tx
+        self.txTree.append(bytes.fromhex(tx.id))
 
+    def addTransactions(self, txs, client=None, executor=None) -> bool:
+        """
+        Adds a batch of transactions in two stages: all signatures are
+        verified up front (in parallel if an executor is given), then the
+        nonce and balance checks run sequentially in block order.
+        """
+        transaction.verify_signatures(txs, executor)
+        for tx in txs:
+            if not self.addTransaction(tx, client):
+                return False
         return True
 
-    def rerun(self, prevBlock) -> bool:
-        self.balances = prevBlock.balances.copy()
-        self.nextNonce = prevBlock.nextNonce.copy()
+    def rerun(self, prevBlock, executor=None) -> bool:
+        self.balances = LedgerState(prevBlock.balances)
+        self.nextNonce = LedgerState(prevBlock.nextNonce)
 
         if self.rewardAddr:
             winner_balance = self.balanceOf(prevBlock.rewardAddr)
@@ -124,12 +276,8 @@ class Block:
 
         txs = list(self.transactions.values())
         self.transactions = {}
-        for tx in txs:
-            success = self.addTransaction(tx)
-            if not success:
-                return False
-
-        return True
+        self.txTree = merkle.MerkleTree()
+        return self.addTransactions(txs, executor=executor)
 
     def balanceOf(self, addr: str) -> float:
         return self.balances.get(addr, 0.0)
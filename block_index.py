@@ -0,0 +1,86 @@
+class BlockIndex:
+    """
+    Tracks the parent and cumulative work of every known block, together
+    with a jump table of ancestors at power-of-two distances (parent,
+    grandparent, 4th ancestor, ...).  Ancestor and common-ancestor queries
+    then take O(log n) steps instead of walking the chain one block at a
+    time.
+    """
+
+    def __init__(self):
+        self.heights = {}
+        self.jumps = {}
+        self.works = {}
+
+    def __contains__(self, blockId):
+        return blockId in self.heights
+
+    def __len__(self):
+        return len(self.heights)
+
+    def add(self, blockId, parentId, height, work=0):
+        """
+        Indexes a block.  Its parent must already be indexed, unless the block
+        is the genesis block, and its height must be one more than the parent's.
+
+        :param work: work of the block itself; the index sums it along the chain.
+        """
+        if blockId in self.heights:
+            return
+        jumps = []
+        if parentId is not None:
+            if parentId not in self.heights:
+                raise KeyError(f"Parent {parentId} of block {blockId} is not indexed.")
+            if height != self.heights[parentId] + 1:
+                raise ValueError(f"Block {blockId} claims height {height}, but its parent is at "
+                                 f"{self.heights[parentId]}.")
+            jumps.append(parentId)
+            while len(self.jumps[jumps[-1]]) >= len(jumps):
+                jumps.append(self.jumps[jumps[-1]][len(jumps) - 1])
+        self.heights[blockId] = height
+        self.jumps[blockId] = jumps
+        self.works[blockId] = self.works.get(parentId, 0) + work
+
+    def height(self, blockId):
+        return self.heights[blockId]
+
+    def totalWork(self, blockId):
+        return self.works[blockId]
+
+    def parent(self, blockId):
+        jumps = self.jumps[blockId]
+        return jumps[0] if jumps else None
+
+    def ancestorAtHeight(self, blockId, height):
+        """
+        Returns the id of the ancestor of blockId at the given height (the
+        block itself if it is at that height), or None if there is none.
+        """
+        current = self.heights[blockId]
+        if height > current or height < 0:
+            return None
+        while current > height:
+            jumps = self.jumps[blockId]
+            k = min((current - height).bit_length() - 1, len(jumps) - 1)
+            blockId = jumps[k]
+            current = self.heights[blockId]
+        return blockId
+
+    def commonAncestor(self, a, b):
+        """
+        Returns the id of the lowest common ancestor of two blocks, or None
+        if they are not in the same tree.
+        """
+        height = min(self.heights[a], self.heights[b])
+        a = self.ancestorAtHeight(a, height)
+        b = self.ancestorAtHeight(b, height)
+        if a == b:
+            return a
+        for k in reversed(range(len(self.jumps[a]))):
+            jumpsA, jumpsB = self.jumps[a], self.jumps[b]
+            if k < len(jumpsA) and jumpsA[k] != jumpsB[k]:
+                a, b = jumpsA[k], jumpsB[k]
+        return self.parent(a) if self.parent(a) == self.parent(b) else None
+
+    def isAncestor(self, ancestorId, blockId) -> bool:
+        return self.ancestorAtHeight(blockId, self.heights[ancestorId]) == ancestorId
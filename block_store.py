@@ -0,0 +1,69 @@
+from collections.abc import MutableMapping
+import sqlite3
+from threading import Lock
+
+from codec import encodeBlock, decodeBlock
+from utils import LRUCache
+
+# Number of recently used blocks kept in memory.
+DEFAULT_CACHE_SIZE = 256
+
+
+class SqliteBlockStore(MutableMapping):
+    """
+    Keeps blocks in an sqlite3 database in their binary encoding, keyed by
+    id, with the most recently used blocks cached in memory.  It can replace
+    the dict in Client.blocks; heights and parent links are looked up in the
+    client's BlockIndex, not here.
+
+    Blocks read back from the database carry their header and transactions,
+    but not balances or nonces; a client keeps those in its Ledger.
+    """
+
+    def __init__(self, path=':memory:', cacheSize=DEFAULT_CACHE_SIZE):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS blocks (id TEXT PRIMARY KEY, body BLOB)")
+        self.cache = LRUCache(cacheSize)
+        self.lock = Lock()
+
+    def _query(self, sql, *args):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def __getitem__(self, blockId):
+        block = self.cache.get(blockId)
+        if block is None:
+            rows = self._query("SELECT body FROM blocks WHERE id = ?", blockId)
+            if not rows:
+                raise KeyError(blockId)
+            block = decodeBlock(rows[0][0])
+            self.cache.put(blockId, block)
+        return block
+
+    def __setitem__(self, blockId, block):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO blocks (id, body) VALUES (?, ?)", (blockId, encodeBlock(block)))
+            self.db.commit()
+        self.cache.put(blockId, block)
+
+    def __delitem__(self, blockId):
+        with self.lock:
+            deleted = self.db.execute("DELETE FROM blocks WHERE id = ?", (blockId,)).rowcount
+            self.db.commit()
+        self.cache.pop(blockId)
+        if not deleted:
+            raise KeyError(blockId)
+
+    def __contains__(self, blockId):
+        return self.cache.get(blockId) is not None or \
+            bool(self._query("SELECT 1 FROM blocks WHERE id = ?", blockId))
+
+    def __iter__(self):
+        return iter([row[0] for row in self._query("SELECT id FROM blocks")])
+
+    def __len__(self):
+        return self._query("SELECT COUNT(*) FROM blocks")[0][0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -5,18 +5,49 @@ import time
 from block import Block
 
 # Network message constants
-MISSING_BLOCK = "MISSING_BLOCK"
+GET_BLOCKS = "GET_BLOCKS"
+BLOCKS = "BLOCKS"
+COMPACT_BLOCK = "COMPACT_BLOCK"
+GET_BLOCK_TXN = "GET_BLOCK_TXN"
+BLOCK_TXN = "BLOCK_TXN"
 POST_TRANSACTION = "POST_TRANSACTION"
 PROOF_FOUND = "PROOF_FOUND"
 START_MINING = "START_MINING"
+GET_HEADERS = "GET_HEADERS"
+HEADERS = "HEADERS"
+GET_BLOCK_BODIES = "GET_BLOCK_BODIES"
+BLOCK_BODIES = "BLOCK_BODIES"
 
 # Constants for mining
 NUM_ROUNDS_MINING = 2000
 
+# Constants for headers-first synchronization
+HEADERS_BATCH_SIZE = 2000
+BODIES_BATCH_SIZE = 100
+
+# Most blocks sent in answer to one GET_BLOCKS request.
+MAX_BLOCKS_PER_MESSAGE = 128
+
+# Most compact blocks a client keeps while waiting for their missing
+# transactions, and how many seconds it waits for them.
+MAX_PENDING_COMPACT_BLOCKS = 100
+COMPACT_BLOCK_TIMEOUT = 30
+
 # Constants related to proof-of-work target
 POW_BASE_TARGET = 0xffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff
 POW_LEADING_ZEROES = 15
 
+# Constants for difficulty retargeting.  Block timestamps are in milliseconds.
+RETARGET_INTERVAL = 20
+TARGET_BLOCK_TIME = 5000
+MAX_RETARGET_FACTOR = 4
+
+# A block's timestamp must be later than the median of its parent and the
+# parent's 10 predecessors, and at most one retarget interval ahead of the
+# receiving client's clock.
+MEDIAN_TIME_SPAN = 11
+MAX_FUTURE_BLOCK_TIME = RETARGET_INTERVAL * TARGET_BLOCK_TIME
+
 # Constants for mining rewards and default transaction fees
 COINBASE_AMT_ALLOWED = 25
 DEFAULT_TX_FEE = 1
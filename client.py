@@ -1,14 +1,23 @@
+from collections import deque
+
 from events import Events
 
 import blockchain
-from block import Block
+from block import Block, blockWork
+from block_index import BlockIndex
+import codec
+from difficulty import Difficulty
+from ledger import Ledger
+from orphan_pool import OrphanPool
+import transaction
 import utils
 
 class Client(Events):
     lastConfirmedBlock: Block
     lastBlock: Block
 
-    def __init__(self, name=None, net=None, startingBlock=None, keyPair=None):
+    def __init__(self, name=None, net=None, startingBlock=None, keyPair=None, blockStore=None, difficulty=None,
+                 verifyExecutor=None):
         super().__init__()
         self.net = net
         self.name = name
@@ -23,29 +32,158 @@ class Client(Events):
         self.nonce = 0
         self.pendingOutgoingTransactions = {}
         self.pendingReceivedTransactions = {}
-        self.blocks = {}
-        self.pendingBlocks = {}
+        # Any mapping of block ids to blocks, e.g. a SqliteBlockStore.
+        self.blocks = {} if blockStore is None else blockStore
+        self.blockIndex = BlockIndex()
+        self.difficulty = Difficulty() if difficulty is None else difficulty
+        # Optional executor, e.g. a ProcessPoolExecutor, for checking signatures.
+        self.verifyExecutor = verifyExecutor
+
+        # The blocks that have no children, and a heap of them by cumulative
+        # work, so the best tip is found in O(log n).  Among equal work, the
+        # tip seen first wins.
+        self.tipIds = set()
+        self.tips = utils.LazyHeap(self.tipIds)
+        self.invalidBlocks = set()
+        self.pendingBlocks = OrphanPool()
+        # Compact blocks waiting for missing transactions, by block id, in
+        # the order they arrived, with the time they arrived.
+        self.compactBlocks = {}
+
+        # State of a headers-first sync, see startSync.
+        self.syncPeers = []
+        self.syncHeaders = []
+        # Heights of the checked headers whose bodies are not connected yet,
+        # and the height of the last checked header.
+        self.syncHeights = {}
+        self.syncHeight = 0
+        self.syncBodies = {}
+        self.syncNext = 0
 
         if startingBlock:
             self.setGenesisBlock(startingBlock)
 
         self.on(blockchain.PROOF_FOUND, self.receiveBlock)
-        self.on(blockchain.MISSING_BLOCK, self.provideMissingBlock)
+        self.on(blockchain.COMPACT_BLOCK, self.receiveCompactBlock)
+        self.on(blockchain.GET_BLOCK_TXN, self.provideBlockTxn)
+        self.on(blockchain.BLOCK_TXN, self.receiveBlockTxn)
+        self.on(blockchain.GET_BLOCKS, self.provideBlocks)
+        self.on(blockchain.BLOCKS, self.receiveBlocks)
+        self.on(blockchain.GET_HEADERS, self.provideHeaders)
+        self.on(blockchain.HEADERS, self.receiveHeaders)
+        self.on(blockchain.GET_BLOCK_BODIES, self.provideBodies)
+        self.on(blockchain.BLOCK_BODIES, self.receiveBodies)
+
+    def on(self, event, handler):
+        """
+        Calls handler with the payload of every event of the given kind,
+        e.g. the messages delivered by the network.
+        """
+        slot = getattr(self, event)
+        slot += handler
+
+    def emit(self, event, *args):
+        """
+        Calls the handlers registered for the event, in the order they were
+        added.
+        """
+        getattr(self, event)(*args)
 
     def setGenesisBlock(self, startingBlock):
         if self.lastBlock:
             raise Exception("Cannot set genesis block for existing blockchain.")
-        self.lastConfirmedBlock = Block(startingBlock)
-        self.lastBlock = Block(startingBlock)
-        self.blocks[startingBlock.id] = startingBlock
+        self.lastConfirmedBlock = startingBlock
+        self.lastBlock = startingBlock
+        self.addBlock(startingBlock)
+
+        # Balances and nonces as of lastBlock, moved along with the chain tip.
+        self.ledger = Ledger(startingBlock, maxUndo=blockchain.CONFIRMED_DEPTH)
+
+    def addBlock(self, block):
+        """
+        Stores a block whose parent is already known, indexes it, and makes
+        it a candidate tip.
+        """
+        self.blockIndex.add(block.id, block.prevBlockHash, block.chainLength, blockWork(block.target))
+        self.blocks[block.id] = block
+        self.tipIds.discard(block.prevBlockHash)
+        self.addTip(block.id)
+
+    def addTip(self, blockId):
+        self.tipIds.add(blockId)
+        self.tips.push(-self.blockIndex.totalWork(blockId), blockId)
+        self.tips.compact()
+
+    def bestTip(self):
+        """
+        Id of the tip with the most cumulative work.
+        """
+        return self.tips.peek()
+
+    def updateTip(self):
+        """
+        Moves the ledger and lastBlock to the best tip.  Only the blocks
+        between the old and new tips and their common ancestor are visited.
+        A branch holding a block that cannot be applied is dropped, and the
+        next best tip is tried.
+        """
+        oldTipId = self.ledger.tipId
+        while self.bestTip() != self.ledger.tipId:
+            bestId = self.bestTip()
+            if not self.ledger.canReorg(bestId, self.blockIndex):
+                # The fork left our chain below the confirmed blocks, whose
+                # undo logs are gone.  Such forks are stale, as in acceptBlock.
+                self.tipIds.discard(bestId)
+                continue
+            if self.ledger.reorg(bestId, self.blocks, self.blockIndex):
+                break
+            # The ledger stopped at the parent of the bad block.
+            parentId = self.ledger.tipId
+            self.invalidBlocks.add(self.blockIndex.ancestorAtHeight(bestId, self.blockIndex.height(parentId) + 1))
+            self.tipIds.discard(bestId)
+            self.addTip(parentId)
+        if self.ledger.tipId != oldTipId:
+            self.lastBlock = self.blocks[self.ledger.tipId]
+            self.tipChanged(oldTipId)
+
+    def tipChanged(self, oldTipId):
+        """
+        Updates what we track about our own transactions after lastBlock
+        moved away from oldTipId, looking only at the new branch.
+        """
+        tipId = self.lastBlock.id
+        ancestor = self.blockIndex.commonAncestor(oldTipId, tipId)
+        blockId = tipId
+        while blockId != ancestor:
+            for txId in self.blocks[blockId].transactions:
+                self.pendingReceivedTransactions.pop(txId, None)
+            blockId = self.blockIndex.parent(blockId)
+        self.nonce = self.ledger.nextNonce.get(self.address, 0)
+        confirmedHeight = max(0, self.lastBlock.chainLength - blockchain.CONFIRMED_DEPTH)
+        self.lastConfirmedBlock = self.blocks[self.blockIndex.ancestorAtHeight(tipId, confirmedHeight)]
+
+    def confirmationDepth(self, blockId):
+        """
+        Number of blocks built on top of the given block in our current chain,
+        or in the chain of headers fetched by startSync if the block's body has
+        not been connected yet, or None if the block is in neither.
+        """
+        if blockId in self.syncHeights:
+            return self.syncHeight - self.syncHeights[blockId]
+        if blockId not in self.blockIndex or not self.blockIndex.isAncestor(blockId, self.lastBlock.id):
+            return None
+        return self.lastBlock.chainLength - self.blockIndex.height(blockId)
 
     @property
     def confirmedBalance(self):
-        return self.lastConfirmedBlock.balanceOf(self.address)
+        # Blocks read back from a block store or the wire carry no balances,
+        # so they come from the ledger, rolled back to lastConfirmedBlock.
+        depth = self.lastBlock.chainLength - self.lastConfirmedBlock.chainLength
+        return self.ledger.balanceAt(self.address, depth)
 
     @property
     def availableGold(self):
-        pendingSpent = sum(tx.totalOutput() for tx in self.pendingOutgoingTransactions.values())
+        pendingSpent = sum(tx.total_output() for tx in self.pendingOutgoingTransactions.values())
         return self.confirmedBalance - pendingSpent
 
     def postTransaction(self, outputs, fee=blockchain.DEFAULT_TX_FEE):
@@ -58,30 +196,358 @@ class Client(Events):
         tx = blockchain.createTransaction(txData, self.keyPair)
         self.pendingOutgoingTransactions[tx.id] = tx
         self.emit('transaction', tx)
-        self.net.broadcast(tx.toJSON())
+        self.net.broadcast(blockchain.POST_TRANSACTION, tx, sender=self.address)
         return tx
 
-    def receiveBlock(self, block):
-        if block.prev != self.lastBlock.id:
-            self.emit(blockchain.MISSING_BLOCK, block.prev)
-            self.pendingBlocks.setdefault(block.prev, []).append(block)
+    def confirmTransaction(self, txId, header, proof):
+        """
+        Confirms that one of our transactions landed in a block, using only
+        the block's header and an inclusion proof for the transaction.  The
+        block must be on our chain, or among the headers checked by startSync,
+        with at least CONFIRMED_DEPTH blocks on top of it; a valid
+        proof-of-work alone is cheap to fake.
+        """
+        depth = self.confirmationDepth(header.hashVal())
+        if depth is None or depth < blockchain.CONFIRMED_DEPTH:
+            return False
+        if not Block.verifyInclusion(txId, proof, header.txRoot):
+            return False
+        self.pendingOutgoingTransactions.pop(txId, None)
+        return True
+
+    def receiveBlock(self, block, requestMissing=True):
+        try:
+            block = codec.toBlock(block)
+        except codec.DecodeError as e:
+            self.log(f"Could not decode block: {e}")
+            return None
+        block = self.acceptBlock(block, requestMissing)
+        if block is None:
+            return None
+
+        # Connect any orphans that were waiting on this block, and on those in
+        # turn, from a work queue rather than by recursion.
+        queue = deque([block.id])
+        while queue:
+            for child in self.pendingBlocks.popChildren(queue.popleft()):
+                connected = self.acceptBlock(child, requestMissing=False)
+                if connected is not None:
+                    queue.append(connected.id)
+
+        return block
+
+    def acceptBlock(self, block, requestMissing):
+        """
+        Connects a block to the block tree, switching to it if it makes the
+        best tip, or parks it in the orphan pool.
+
+        :return: the block if it was connected, otherwise None.
+        """
+        # Binary blocks arrive as a lazy view; the checks below only need the
+        # header, so blocks we turn away never have their transactions decoded.
+        if block.id in self.blocks or block.id in self.pendingBlocks or not block.hasValidProof():
+            return None
+        if block.prevBlockHash in self.invalidBlocks:
+            self.invalidBlocks.add(block.id)
+            return None
+        if block.chainLength + blockchain.CONFIRMED_DEPTH <= self.lastBlock.chainLength:
+            # Forks below our confirmed block are stale.
+            return None
+        if block.prevBlockHash not in self.blockIndex:
+            # Only the first orphan waiting on a parent asks for it, and not
+            # if the parent is itself a known orphan.
+            requested = self.pendingBlocks.isWaitingFor(block.prevBlockHash) or \
+                block.prevBlockHash in self.pendingBlocks
+            if self.pendingBlocks.add(block) and requestMissing and not requested:
+                self.requestMissingBlocks(block)
+            return None
+        if block.chainLength != self.blockIndex.height(block.prevBlockHash) + 1:
+            # The chain length comes from the peer and the index relies on it.
+            # It is not covered by the header hash, so the id is not marked
+            # invalid: the same block with the right length may still come.
+            return None
+        if block.coinbaseReward != blockchain.COINBASE_AMT_ALLOWED:
+            # Likewise not covered by the header.
+            return None
+        if not self.difficulty.isValidTarget(block, self.blocks, self.blockIndex) or \
+                not self.difficulty.isValidTimestamp(block, self.blocks, self.blockIndex):
+            self.invalidBlocks.add(block.id)
+            return None
+        if block.timestamp > utils.now() * 1000 + blockchain.MAX_FUTURE_BLOCK_TIME:
+            # It may become acceptable as our clock catches up, so it is not
+            # marked invalid.
+            return None
+
+        try:
+            block = codec.materialize(block)
+        except codec.DecodeError as e:
+            # A body that does not match its header says nothing about the
+            # block with that id, so it is dropped without marking it invalid.
+            self.log(f"Could not decode block {block.id}: {e}")
+            return None
+
+        # The ledger only checks nonces and balances, so every signature in
+        # the block is checked here, before the block can become the tip.
+        if not transaction.verify_signatures(list(block.transactions.values()), self.verifyExecutor):
+            self.invalidBlocks.add(block.id)
+            return None
+
+        self.addBlock(block)
+        self.updateTip()
+        return block
+
+    def requestMissingBlocks(self, block):
+        """
+        Asks for the missing ancestors of an orphaned block in one GET_BLOCKS
+        request, from the miner that found the block if it is on the network.
+        Enough blocks are requested to reach back to our tip, plus
+        CONFIRMED_DEPTH more in case the block is on a fork.
+        """
+        count = block.chainLength - self.lastBlock.chainLength + blockchain.CONFIRMED_DEPTH
+        self.askMiner(block, blockchain.GET_BLOCKS, {'from': self.address, 'blockId': block.prevBlockHash,
+                                                     'count': max(1, min(count, blockchain.MAX_BLOCKS_PER_MESSAGE))})
+
+    def askMiner(self, block, msg, request):
+        """
+        Sends a request about a block to the miner that found it, or to
+        everyone if that miner is not on the network.
+        """
+        if self.net.recognizes(block.rewardAddr):
+            self.net.send_message(block.rewardAddr, msg, request)
+        else:
+            self.net.broadcast(msg, request, sender=self.address)
+
+    def provideBlocks(self, o):
+        """
+        Answers GET_BLOCKS with up to count blocks in one message, starting
+        with the requested block and following parent links back.
+        """
+        count = min(o['count'], blockchain.MAX_BLOCKS_PER_MESSAGE)
+        blockId = o['blockId']
+        blocks = []
+        while blockId in self.blockIndex and len(blocks) < count:
+            blocks.append(self.blocks[blockId])
+            blockId = self.blockIndex.parent(blockId)
+        if blocks:
+            self.net.send_message(o['from'], blockchain.BLOCKS, codec.encodeBlocks(blocks))
+
+    def receiveBlocks(self, buf):
+        try:
+            blocks = codec.decodeBlocks(buf)
+        except codec.DecodeError as e:
+            self.log(f"Could not decode blocks: {e}")
             return
+        # Oldest first, so each block finds its parent.  Only the oldest can
+        # be missing an ancestor that was not part of this response.
+        for block in reversed(blocks):
+            self.receiveBlock(block, requestMissing=block is blocks[-1])
 
-        # Confirm any transactions in this block.
-        self.lastConfirmedBlock = block
-        for tx in block.transactions:
-            if tx.id in self.pendingReceivedTransactions:
-                self.pendingReceivedTransactions.pop(tx.id)
-            if tx.inputs[0]['address'] == self.address:
-                self.nonce += 1
-        self.lastBlock = block
-        self.blocks[block.id] = block
+    def knownTransactions(self):
+        """
+        Transactions we hold that a compact block may refer to.
+        """
+        return list(self.pendingOutgoingTransactions.values()) + list(self.pendingReceivedTransactions.values())
+
+    def receiveCompactBlock(self, buf):
+        """
+        Rebuilds a block announced by header and short transaction ids from
+        the transactions we already hold, and asks the miner for the rest.
+        """
+        try:
+            compact = codec.CompactBlock(buf)
+        except codec.DecodeError as e:
+            self.log(f"Could not decode compact block: {e}")
+            return None
+        # Once an entry expires, a new announcement of the block is followed
+        # up again, in case the BLOCK_TXN answer was lost.
+        self.expireCompactBlocks()
+        if compact.id in self.blocks or compact.id in self.compactBlocks or not compact.hasValidProof():
+            return None
+        if compact.chainLength + blockchain.CONFIRMED_DEPTH <= self.lastBlock.chainLength:
+            return None
+        found, missing = compact.match(self.knownTransactions())
+        if missing:
+            self.compactBlocks[compact.id] = (compact, found, utils.now())
+            self.expireCompactBlocks()
+            self.askMiner(compact, blockchain.GET_BLOCK_TXN,
+                          {'from': self.address, 'blockId': compact.id, 'indexes': missing})
+            return None
+        return self.completeCompactBlock(compact, found)
+
+    def expireCompactBlocks(self):
+        """
+        Drops compact blocks that waited longer than COMPACT_BLOCK_TIMEOUT,
+        and the oldest ones beyond MAX_PENDING_COMPACT_BLOCKS.
+        """
+        cutoff = utils.now() - blockchain.COMPACT_BLOCK_TIMEOUT
+        while self.compactBlocks:
+            blockId, (_, _, added) = next(iter(self.compactBlocks.items()))
+            if added >= cutoff and len(self.compactBlocks) <= blockchain.MAX_PENDING_COMPACT_BLOCKS:
+                break
+            del self.compactBlocks[blockId]
+
+    def completeCompactBlock(self, compact, txs):
+        try:
+            block = compact.toBlock(txs)
+        except codec.DecodeError:
+            # A short id collision; fall back to fetching the full block.
+            self.askMiner(compact, blockchain.GET_BLOCKS, {'from': self.address, 'blockId': compact.id, 'count': 1})
+            return None
+        return self.receiveBlock(block)
+
+    def provideBlockTxn(self, o):
+        block = self.blocks.get(o['blockId'])
+        if block is None:
+            return
+        txs = list(block.transactions.values())
+        self.net.send_message(o['from'], blockchain.BLOCK_TXN,
+                              codec.encodeBlockTxn(o['blockId'], [txs[i] for i in o['indexes'] if i < len(txs)]))
+
+    def receiveBlockTxn(self, buf):
+        try:
+            blockId, txs = codec.decodeBlockTxn(buf)
+        except codec.DecodeError as e:
+            self.log(f"Could not decode block transactions: {e}")
+            return None
+        if blockId not in self.compactBlocks:
+            return None
+        compact, found, _ = self.compactBlocks.pop(blockId)
+        missing = iter(txs)
+        found = [tx if tx is not None else next(missing, None) for tx in found]
+        if None in found:
+            return None
+        return self.completeCompactBlock(compact, found)
+
+    def blockLocator(self):
+        """
+        Ids of blocks on our chain, from the tip back to the genesis block,
+        one apart for the first ten and then at doubling distances.  A peer
+        can find the last block we have in common from it.
+        """
+        tipId = self.lastBlock.id
+        height = self.lastBlock.chainLength
+        locator = []
+        step = 1
+        while height > 0:
+            locator.append(self.blockIndex.ancestorAtHeight(tipId, height))
+            if len(locator) >= 10:
+                step *= 2
+            height -= step
+        locator.append(self.blockIndex.ancestorAtHeight(tipId, 0))
+        return locator
+
+    def startSync(self, peers):
+        """
+        Catches up with the chain of our peers, headers first.  Headers are
+        fetched from the first peer in batches, and each batch is checked for
+        proof-of-work and linkage before the next is requested.  The bodies
+        are then requested in batches spread over all peers, and connected in
+        chain order as they arrive.
+
+        :param peers: addresses of the peers to sync from.
+        """
+        self.syncPeers = list(peers)
+        self.syncHeaders = []
+        self.syncHeights = {}
+        self.syncHeight = 0
+        self.syncBodies = {}
+        self.syncNext = 0
+        self.requestHeaders(self.blockLocator())
+
+    def requestHeaders(self, locator):
+        self.net.send_message(self.syncPeers[0], blockchain.GET_HEADERS,
+                              {'from': self.address, 'locator': locator, 'count': blockchain.HEADERS_BATCH_SIZE})
+
+    def provideHeaders(self, o):
+        """
+        Answers GET_HEADERS with the headers of our chain following the first
+        block of the locator that is on it.
+        """
+        tipId = self.lastBlock.id
+        for blockId in o['locator']:
+            if blockId in self.blockIndex and self.blockIndex.isAncestor(blockId, tipId):
+                break
+        else:
+            return
+        start = self.blockIndex.height(blockId) + 1
+        end = min(self.lastBlock.chainLength, start + min(o['count'], blockchain.HEADERS_BATCH_SIZE) - 1)
+        ids = []
+        blockId = self.blockIndex.ancestorAtHeight(tipId, end)
+        for _ in range(start, end + 1):
+            ids.append(blockId)
+            blockId = self.blockIndex.parent(blockId)
+        headers = [self.blocks[blockId].header for blockId in reversed(ids)]
+        self.net.send_message(o['from'], blockchain.HEADERS, codec.encodeHeaders(headers))
+
+    def receiveHeaders(self, buf):
+        if not self.syncPeers:
+            return
+        try:
+            headers = codec.decodeHeaders(buf)
+        except codec.DecodeError as e:
+            self.dropSyncPeer(f"Could not decode headers from {self.syncPeers[0]}: {e}")
+            return
+        heights = {}
+        prevId = self.syncHeaders[-1] if self.syncHeaders else None
+        height = self.syncHeight
+        for header in headers:
+            parentId = header.prevBlockHash.hex()
+            linked = parentId == prevId if prevId is not None else parentId in self.blockIndex
+            if not linked or not header.hasValidProof():
+                self.dropSyncPeer(f"Invalid header from {self.syncPeers[0]}.")
+                return
+            if prevId is None:
+                height = self.blockIndex.height(parentId)
+            prevId = header.hashVal()
+            height += 1
+            heights[prevId] = height
+        self.syncHeaders.extend(heights)
+        self.syncHeights.update(heights)
+        self.syncHeight = height
+
+        if len(headers) == blockchain.HEADERS_BATCH_SIZE:
+            self.requestHeaders([prevId] + self.blockLocator())
+        else:
+            self.requestBodies()
+
+    def dropSyncPeer(self, reason):
+        """
+        Gives up on the peer we are fetching headers from and asks the next
+        one, from the last header we accepted.
+        """
+        self.log(reason)
+        self.syncPeers.pop(0)
+        if self.syncPeers:
+            self.requestHeaders(self.syncHeaders[-1:] + self.blockLocator())
+
+    def requestBodies(self):
+        ids = [blockId for blockId in self.syncHeaders[self.syncNext:] if blockId not in self.syncBodies]
+        if not ids:
+            self.syncPeers = []
+            return
+        batchSize = blockchain.BODIES_BATCH_SIZE
+        for n, i in enumerate(range(0, len(ids), batchSize)):
+            peer = self.syncPeers[n % len(self.syncPeers)]
+            self.net.send_message(peer, blockchain.GET_BLOCK_BODIES, {'from': self.address, 'ids': ids[i:i + batchSize]})
 
-        # Remove any pending blocks that depended on this one.
-        for pendingBlock in self.pendingBlocks.pop(block.id, []):
-            self.receiveBlock(pendingBlock)
+    def provideBodies(self, o):
+        blocks = [self.blocks[blockId] for blockId in o['ids'] if blockId in self.blocks]
+        self.net.send_message(o['from'], blockchain.BLOCK_BODIES, codec.encodeBlocks(blocks))
 
-    def provideMissingBlock(self, blockId):
-        if blockId not in self.blocks:
+    def receiveBodies(self, buf):
+        try:
+            blocks = codec.decodeBlocks(buf)
+        except codec.DecodeError as e:
+            self.log(f"Could not decode block bodies: {e}")
             return
-        self.net.sendMessage('block', self.blocks[blockId].toJSON())
+        for block in blocks:
+            # Only bodies matching a header we have already checked.
+            if block.id in self.syncHeights:
+                self.syncBodies[block.id] = block
+        while self.syncNext < len(self.syncHeaders) and self.syncHeaders[self.syncNext] in self.syncBodies:
+            blockId = self.syncHeaders[self.syncNext]
+            self.receiveBlock(self.syncBodies.pop(blockId))
+            del self.syncHeights[blockId]
+            self.syncNext += 1
+        if self.syncPeers and self.syncNext == len(self.syncHeaders):
+            self.syncPeers = []
@@ -0,0 +1,514 @@
+"""
+Versioned binary encoding for blocks, block headers and transactions.
+
+Every message starts with a version byte and a kind byte.  Hashes and
+addresses that are hex digests travel as raw bytes, and variable-length
+fields are length-prefixed.  Decoding works on a memoryview and only copies
+the fields that have to become Python objects.
+"""
+import base64
+from collections.abc import Mapping
+from functools import lru_cache
+import hashlib
+import json
+import struct
+
+from block import Block, BlockHeader, HEADER_SIZE
+from transaction import Transaction
+
+VERSION = 1
+
+KIND_BLOCK = 1
+KIND_HEADER = 2
+KIND_TRANSACTION = 3
+KIND_HEADERS = 4
+KIND_BLOCKS = 5
+KIND_COMPACT_BLOCK = 6
+KIND_BLOCK_TXN = 7
+
+PREFIX = struct.Struct('>BB')
+U8 = struct.Struct('>B')
+U16 = struct.Struct('>H')
+U32 = struct.Struct('>I')
+BLOCK_FIELDS = struct.Struct('>32s32sQ32sQIq')
+TX_FIELDS = struct.Struct('>Qq')
+AMOUNT = struct.Struct('>q')
+# Fixed-size runs read in one go when decoding: the transaction fields with
+# the kind and length of the key that follows, and an output's amount with
+# the kind of its address.
+TX_HEAD = struct.Struct('>QqBI')
+OUTPUT_HEAD = struct.Struct('>qB')
+
+# Length of the transaction ids in a compact block.
+SHORT_ID_SIZE = 6
+
+# Kinds of string fields.
+STR_NONE = 0
+STR_HEX = 1
+STR_TEXT = 2
+
+NO_BYTES = 0xffffffff
+
+# Kinds of key fields.  PEM keys in the standard layout are sent as DER.
+KEY_RAW = 0
+KEY_PEM = 1
+PEM_BEGIN = b'-----BEGIN PUBLIC KEY-----'
+PEM_END = b'-----END PUBLIC KEY-----'
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def _putStr(out, s):
+    if s is None:
+        out.append(U8.pack(STR_NONE))
+        return
+    raw = None
+    if len(s) % 2 == 0:
+        try:
+            raw = bytes.fromhex(s)
+        except ValueError:
+            pass
+    if raw is not None and raw.hex() == s:
+        out.append(U8.pack(STR_HEX))
+    else:
+        raw = s.encode()
+        out.append(U8.pack(STR_TEXT))
+    out.append(U16.pack(len(raw)))
+    out.append(raw)
+
+
+def _getStr(view, offset):
+    kind, = U8.unpack_from(view, offset)
+    offset += 1
+    if kind == STR_NONE:
+        return None, offset
+    length, = U16.unpack_from(view, offset)
+    offset += 2
+    raw = view[offset:offset + length]
+    offset += length
+    if kind == STR_HEX:
+        return raw.hex(), offset
+    if kind == STR_TEXT:
+        return str(raw, 'utf-8'), offset
+    raise DecodeError(f"Unknown string kind {kind}.")
+
+
+def _putBytes(out, b):
+    if b is None:
+        out.append(U32.pack(NO_BYTES))
+    else:
+        out.append(U32.pack(len(b)))
+        out.append(b)
+
+
+def _getBytes(view, offset):
+    length, = U32.unpack_from(view, offset)
+    offset += 4
+    if length == NO_BYTES:
+        return None, offset
+    return view[offset:offset + length], offset + length
+
+
+@lru_cache(maxsize=1024)
+def _pem(der: bytes) -> bytes:
+    b64 = base64.b64encode(der)
+    lines = [b64[i:i + 64] for i in range(0, len(b64), 64)]
+    return b'\n'.join([PEM_BEGIN] + lines + [PEM_END])
+
+
+@lru_cache(maxsize=1024)
+def _keyForm(key: bytes):
+    if key.startswith(PEM_BEGIN):
+        try:
+            der = base64.b64decode(b''.join(key.splitlines()[1:-1]), validate=True)
+        except ValueError:
+            der = None
+        if der is not None and _pem(der) == key:
+            return KEY_PEM, der
+    return KEY_RAW, key
+
+
+def _putKey(out, key):
+    kind, raw = _keyForm(key)
+    out.append(U8.pack(kind))
+    _putBytes(out, raw)
+
+
+def _getKey(view, offset):
+    kind, = U8.unpack_from(view, offset)
+    raw, offset = _getBytes(view, offset + 1)
+    if kind == KEY_PEM:
+        return _pem(bytes(raw)), offset
+    if kind == KEY_RAW:
+        return bytes(raw), offset
+    raise DecodeError(f"Unknown key kind {kind}.")
+
+
+def _checkPrefix(view, kind):
+    try:
+        version, actual = PREFIX.unpack_from(view, 0)
+    except struct.error as e:
+        raise DecodeError("Message too short.") from e
+    if version != VERSION:
+        raise DecodeError(f"Unsupported encoding version {version}.")
+    if actual != kind:
+        raise DecodeError(f"Expected message kind {kind}, got {actual}.")
+    return PREFIX.size
+
+
+def _hashOrNone(raw):
+    return None if raw == bytes(32) else raw.hex()
+
+
+def _encodeTx(out, tx):
+    pub_key = tx.pub_key.encode() if isinstance(tx.pub_key, str) else tx.pub_key
+    sig = tx.sig.encode() if isinstance(tx.sig, str) else tx.sig
+    _putStr(out, tx.from_address)
+    out.append(TX_FIELDS.pack(tx.nonce, tx.fee))
+    _putKey(out, pub_key)
+    _putBytes(out, sig)
+    out.append(U16.pack(len(tx.outputs)))
+    for output in tx.outputs:
+        out.append(AMOUNT.pack(output['amount']))
+        _putStr(out, output['address'])
+    _putBytes(out, json.dumps(dict(tx.data), separators=(',', ':')).encode() if tx.data else None)
+
+
+def _decodeTx(view, offset):
+    # The field readers are inlined for the common string and key kinds,
+    # since blocks decode many transactions.
+    kind = view[offset]
+    if kind == STR_HEX:
+        length, = U16.unpack_from(view, offset + 1)
+        offset += 3
+        from_address = view[offset:offset + length].hex()
+        offset += length
+    else:
+        from_address, offset = _getStr(view, offset)
+    nonce, fee, kind, length = TX_HEAD.unpack_from(view, offset)
+    offset += TX_HEAD.size
+    raw = bytes(view[offset:offset + length])
+    offset += length
+    if kind == KEY_PEM:
+        pub_key = _pem(raw)
+    elif kind == KEY_RAW:
+        pub_key = raw
+    else:
+        raise DecodeError(f"Unknown key kind {kind}.")
+    sig, offset = _getBytes(view, offset)
+    count, = U16.unpack_from(view, offset)
+    offset += 2
+    outputs = []
+    for _ in range(count):
+        amount, kind = OUTPUT_HEAD.unpack_from(view, offset)
+        if kind == STR_HEX:
+            length, = U16.unpack_from(view, offset + OUTPUT_HEAD.size)
+            offset += OUTPUT_HEAD.size + 2
+            address = view[offset:offset + length].hex()
+            offset += length
+        else:
+            address, offset = _getStr(view, offset + AMOUNT.size)
+        outputs.append({'amount': amount, 'address': address})
+    data, offset = _getBytes(view, offset)
+    tx = Transaction(from_address, nonce, pub_key, sig=None if sig is None else bytes(sig),
+                     outputs=outputs, fee=fee, data=json.loads(bytes(data)) if data is not None else None)
+    return tx, offset
+
+
+def encodeTransaction(tx) -> bytes:
+    out = [PREFIX.pack(VERSION, KIND_TRANSACTION)]
+    _encodeTx(out, tx)
+    return b''.join(out)
+
+
+def decodeTransaction(buf) -> Transaction:
+    view = memoryview(buf)
+    tx, _ = _decodeTx(view, _checkPrefix(view, KIND_TRANSACTION))
+    return tx
+
+
+def encodeHeader(header: BlockHeader) -> bytes:
+    return PREFIX.pack(VERSION, KIND_HEADER) + header.serialize()
+
+
+def decodeHeader(buf) -> BlockHeader:
+    view = memoryview(buf)
+    offset = _checkPrefix(view, KIND_HEADER)
+    return BlockHeader.deserialize(view[offset:offset + HEADER_SIZE])
+
+
+def encodeHeaders(headers) -> bytes:
+    """
+    Encodes a run of headers as one message, for headers-first sync.
+    """
+    out = [PREFIX.pack(VERSION, KIND_HEADERS), U32.pack(len(headers))]
+    out.extend(header.serialize() for header in headers)
+    return b''.join(out)
+
+
+def decodeHeaders(buf):
+    view = memoryview(buf)
+    offset = _checkPrefix(view, KIND_HEADERS)
+    try:
+        count, = U32.unpack_from(view, offset)
+    except struct.error as e:
+        raise DecodeError("Missing header count.") from e
+    offset += 4
+    if len(view) != offset + count * HEADER_SIZE:
+        raise DecodeError(f"Expected {count} headers, got {len(view) - offset} bytes.")
+    return [BlockHeader.deserialize(view[i:i + HEADER_SIZE])
+            for i in range(offset, len(view), HEADER_SIZE)]
+
+
+def _putBlockFields(out, kind, block):
+    out.append(PREFIX.pack(VERSION, kind))
+    prev = bytes.fromhex(block.prevBlockHash) if block.prevBlockHash else bytes(32)
+    out.append(BLOCK_FIELDS.pack(prev, block.txRoot(), block.timestamp, block.target.to_bytes(32, 'big'),
+                                 block.proof, block.chainLength, block.coinbaseReward))
+    _putStr(out, block.rewardAddr)
+
+
+def encodeBlock(block) -> bytes:
+    """
+    Encodes a block's header fields and transactions.  Balances and nonces
+    are not part of the encoding.
+    """
+    out = []
+    _putBlockFields(out, KIND_BLOCK, block)
+    out.append(U32.pack(len(block.transactions)))
+    for tx in block.transactions.values():
+        _encodeTx(out, tx)
+    return b''.join(out)
+
+
+class _EncodedBlock:
+    """
+    The header fields of a binary block message, decoded straight away.
+    """
+    KIND = None
+
+    def __init__(self, buf):
+        self.view = memoryview(buf)
+        offset = _checkPrefix(self.view, self.KIND)
+        try:
+            (prev, self.txRoot, self.timestamp, target, self.proof, self.chainLength,
+             self.coinbaseReward) = BLOCK_FIELDS.unpack_from(self.view, offset)
+            self.rewardAddr, self.txOffset = _getStr(self.view, offset + BLOCK_FIELDS.size)
+        except (struct.error, UnicodeDecodeError) as e:
+            raise DecodeError("Truncated block header.") from e
+        self.target = int.from_bytes(target, 'big')
+        self.prevBlockHash = _hashOrNone(prev)
+        self._id = None
+
+    @property
+    def header(self) -> BlockHeader:
+        return BlockHeader(self.prevBlockHash, self.txRoot, self.timestamp, self.target, self.rewardAddr, self.proof)
+
+    @property
+    def id(self):
+        if self._id is None:
+            self._id = self.header.hashVal()
+        return self._id
+
+    def hashVal(self):
+        return self.id
+
+    def hasValidProof(self):
+        return self.header.hasValidProof()
+
+    def _assemble(self, txs) -> Block:
+        b = Block(self.rewardAddr, target=self.target, coinbaseReward=self.coinbaseReward)
+        b.prevBlockHash = self.prevBlockHash
+        b.timestamp = self.timestamp
+        b.proof = self.proof
+        b.chainLength = self.chainLength
+        for tx in txs:
+            b.transactions[tx.id] = tx
+        b.txTree.extend(bytes.fromhex(txId) for txId in b.transactions)
+        if b.txRoot() != self.txRoot:
+            raise DecodeError("Transactions do not match the encoded transactions root.")
+        return b
+
+
+class BlockView(_EncodedBlock):
+    """
+    A binary-encoded block whose header fields are decoded straight away,
+    but whose transactions are only decoded when first needed.  Duplicate,
+    orphaned and stale blocks can then be turned away for the cost of
+    parsing and hashing the header.
+    """
+    KIND = KIND_BLOCK
+
+    def __init__(self, buf):
+        super().__init__(buf)
+        self._block = None
+
+    @property
+    def transactions(self):
+        return self.materialize().transactions
+
+    def materialize(self) -> Block:
+        """
+        Decodes the transactions and returns the full block.
+
+        :raises DecodeError: if the transactions are malformed or do not
+            match the header.
+        """
+        if self._block is None:
+            try:
+                count, = U32.unpack_from(self.view, self.txOffset)
+                offset = self.txOffset + 4
+                txs = []
+                for _ in range(count):
+                    tx, offset = _decodeTx(self.view, offset)
+                    txs.append(tx)
+            except (struct.error, ValueError) as e:
+                raise DecodeError(f"Malformed transactions in block {self.id}.") from e
+            self._block = self._assemble(txs)
+        return self._block
+
+
+def shortTxId(blockId: bytes, txId: str) -> bytes:
+    """
+    Short id of a transaction in a compact block, keyed by the block's id so
+    that colliding ids cannot be precomputed for every block.
+    """
+    return hashlib.blake2b(bytes.fromhex(txId), digest_size=SHORT_ID_SIZE, key=blockId).digest()
+
+
+def encodeCompactBlock(block) -> bytes:
+    """
+    Encodes a block's header fields with a short id per transaction, in
+    place of the transactions themselves.
+    """
+    out = []
+    _putBlockFields(out, KIND_COMPACT_BLOCK, block)
+    blockId = bytes.fromhex(block.id)
+    out.append(U32.pack(len(block.transactions)))
+    out.extend(shortTxId(blockId, txId) for txId in block.transactions)
+    return b''.join(out)
+
+
+class CompactBlock(_EncodedBlock):
+    """
+    A block announced by its header fields and short transaction ids.  The
+    receiver rebuilds it from transactions it already holds, and only has
+    to ask for the rest.
+    """
+    KIND = KIND_COMPACT_BLOCK
+
+    def __init__(self, buf):
+        super().__init__(buf)
+        try:
+            count, = U32.unpack_from(self.view, self.txOffset)
+        except struct.error as e:
+            raise DecodeError(f"Malformed compact block {self.id}.") from e
+        offset = self.txOffset + 4
+        if len(self.view) != offset + count * SHORT_ID_SIZE:
+            raise DecodeError(f"Expected {count} short ids, got {len(self.view) - offset} bytes.")
+        self.shortIds = [bytes(self.view[i:i + SHORT_ID_SIZE]) for i in range(offset, len(self.view), SHORT_ID_SIZE)]
+
+    def match(self, txs):
+        """
+        Looks up the block's transactions among the given ones.
+
+        :return: List holding the transaction or None for each short id, and
+            the indexes of those that were not found.
+        """
+        blockId = bytes.fromhex(self.id)
+        known = {shortTxId(blockId, tx.id): tx for tx in txs}
+        found = [known.get(shortId) for shortId in self.shortIds]
+        return found, [i for i, tx in enumerate(found) if tx is None]
+
+    def toBlock(self, txs) -> Block:
+        """
+        Builds the full block from its transactions, in order.
+
+        :raises DecodeError: if they do not match the header, e.g. because
+            of a short id collision.
+        """
+        return self._assemble(txs)
+
+
+def encodeBlockTxn(blockId, txs) -> bytes:
+    """
+    Encodes transactions sent to complete a compact block.
+    """
+    out = [PREFIX.pack(VERSION, KIND_BLOCK_TXN), bytes.fromhex(blockId), U32.pack(len(txs))]
+    for tx in txs:
+        _encodeTx(out, tx)
+    return b''.join(out)
+
+
+def decodeBlockTxn(buf):
+    """
+    :return: The block id and the list of transactions.
+    """
+    view = memoryview(buf)
+    offset = _checkPrefix(view, KIND_BLOCK_TXN)
+    blockId = view[offset:offset + 32].hex()
+    txs = []
+    try:
+        count, = U32.unpack_from(view, offset + 32)
+        offset += 36
+        for _ in range(count):
+            tx, offset = _decodeTx(view, offset)
+            txs.append(tx)
+    except (struct.error, ValueError) as e:
+        raise DecodeError(f"Malformed transactions for block {blockId}.") from e
+    return blockId, txs
+
+
+def decodeBlock(buf) -> Block:
+    return BlockView(buf).materialize()
+
+
+def encodeBlocks(blocks) -> bytes:
+    """
+    Encodes several blocks as one message.  Blocks that arrived as a
+    BlockView are copied over without being encoded again.
+    """
+    out = [PREFIX.pack(VERSION, KIND_BLOCKS), U32.pack(len(blocks))]
+    for block in blocks:
+        _putBytes(out, block.view if isinstance(block, BlockView) else encodeBlock(block))
+    return b''.join(out)
+
+
+def decodeBlocks(buf):
+    """
+    Returns the blocks in a message from encodeBlocks as lazy BlockViews.
+    """
+    view = memoryview(buf)
+    offset = _checkPrefix(view, KIND_BLOCKS)
+    count, = U32.unpack_from(view, offset)
+    offset += 4
+    blocks = []
+    try:
+        for _ in range(count):
+            raw, offset = _getBytes(view, offset)
+            blocks.append(BlockView(raw))
+    except struct.error as e:
+        raise DecodeError(f"Malformed block {len(blocks)} of {count}.") from e
+    return blocks
+
+
+def toBlock(o):
+    """
+    Accepts a block as received from the network: already a Block, its JSON
+    form, or its binary encoding, which is returned as a lazy BlockView.
+    """
+    if isinstance(o, (bytes, bytearray, memoryview)):
+        return BlockView(o)
+    if isinstance(o, Mapping):
+        # A dict, or the read-only view of a payload shared by FakeNet.
+        return Block.deserialize(o)
+    return o
+
+
+def materialize(block) -> Block:
+    """
+    Returns the full Block for a Block or a BlockView.
+    """
+    return block.materialize() if isinstance(block, BlockView) else block
@@ -0,0 +1,99 @@
+import blockchain
+
+
+class Difficulty:
+    """
+    Retargets the proof-of-work every interval blocks, so that blocks keep
+    arriving every blockTime milliseconds on average as mining power
+    changes.  The new target scales the previous required target by how
+    long the last interval took compared with how long it should have taken.
+
+    Between retargets the required target stays that of the last retarget.
+    A block may use a harder target than required, but never an easier one,
+    and doing so does not make its descendants any harder to mine.
+
+    Since the retarget reads block timestamps, a block's timestamp must be
+    later than the median of the last medianSpan blocks, so that a miner
+    cannot move the clock backwards to make an interval look slow.
+    """
+
+    def __init__(self, interval=blockchain.RETARGET_INTERVAL, blockTime=blockchain.TARGET_BLOCK_TIME,
+                 maxFactor=blockchain.MAX_RETARGET_FACTOR, maxTarget=blockchain.POW_BASE_TARGET,
+                 medianSpan=blockchain.MEDIAN_TIME_SPAN):
+        """
+        :param interval: number of blocks between retargets.
+        :param blockTime: desired time between blocks, in milliseconds.
+        :param maxFactor: most the target can grow or shrink in one retarget.
+        :param maxTarget: easiest target allowed.
+        :param medianSpan: number of blocks whose median timestamp a child must exceed.
+        """
+        self.interval = interval
+        self.blockTime = blockTime
+        self.maxFactor = maxFactor
+        self.maxTarget = maxTarget
+        self.medianSpan = medianSpan
+        # Required target set at each retarget, by the id of the first block
+        # it applies to.
+        self.retargets = {}
+
+    def nextTarget(self, parentId, blocks, index) -> int:
+        """
+        Target required of a child of the given block.  Only the parent and,
+        at a retarget, the block one interval back are read; the latter is
+        found with the index's ancestor jump table.
+
+        :param blocks: Mapping of block ids to blocks.
+        :param index: BlockIndex containing the parent.
+        """
+        height = index.height(parentId) + 1
+        if height % self.interval != 0:
+            return self.requiredTarget(parentId, blocks, index)
+
+        parent = blocks[parentId]
+        first = blocks[index.ancestorAtHeight(parentId, height - self.interval)]
+        expected = (self.interval - 1) * self.blockTime
+        actual = parent.timestamp - first.timestamp
+        actual = max(expected // self.maxFactor, min(actual, expected * self.maxFactor))
+        return min(self.maxTarget, self.requiredTarget(parentId, blocks, index) * actual // expected)
+
+    def requiredTarget(self, blockId, blocks, index) -> int:
+        """
+        Target the given block had to meet, whatever target it was actually
+        mined at: that of the last retarget at or before it, or the genesis
+        block's target before the first one.
+        """
+        height = index.height(blockId)
+        boundary = height - height % self.interval
+        if boundary == 0:
+            return blocks[index.ancestorAtHeight(blockId, 0)].target
+        lastRetargetId = index.ancestorAtHeight(blockId, boundary)
+        # Earlier retargets that are not known yet are worked out first, so
+        # each one only needs the previous required target.
+        pending = []
+        retargetId = lastRetargetId
+        while boundary > 0 and retargetId not in self.retargets:
+            pending.append(retargetId)
+            boundary -= self.interval
+            retargetId = index.ancestorAtHeight(retargetId, boundary)
+        for retargetId in reversed(pending):
+            self.retargets[retargetId] = self.nextTarget(index.parent(retargetId), blocks, index)
+        return self.retargets[lastRetargetId]
+
+    def isValidTarget(self, block, blocks, index) -> bool:
+        return block.target <= self.nextTarget(block.prevBlockHash, blocks, index)
+
+    def medianTimePast(self, parentId, blocks, index) -> int:
+        """
+        Median timestamp of the given block and up to medianSpan - 1 of its
+        ancestors.  A child of the block must have a later timestamp.
+        """
+        times = []
+        blockId = parentId
+        while blockId is not None and len(times) < self.medianSpan:
+            times.append(blocks[blockId].timestamp)
+            blockId = index.parent(blockId)
+        times.sort()
+        return times[len(times) // 2]
+
+    def isValidTimestamp(self, block, blocks, index) -> bool:
+        return block.timestamp > self.medianTimePast(block.prevBlockHash, blocks, index)
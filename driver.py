@@ -37,12 +37,12 @@ donald = Miner(name="Donald", net=fake_net, startingBlock=genesis, miningRounds=
 
 
 def show_balances(client):
-    print(f"Alice has {client.lastBlock.balanceOf(alice.address)} gold.")
-    print(f"Bob has {client.lastBlock.balanceOf(bob.address)} gold.")
-    print(f"Charlie has {client.lastBlock.balanceOf(charlie.address)} gold.")
-    print(f"Minnie has {client.lastBlock.balanceOf(minnie.address)} gold.")
-    print(f"Mickey has {client.lastBlock.balanceOf(mickey.address)} gold.")
-    print(f"Donald has {client.lastBlock.balanceOf(donald.address)} gold.")
+    print(f"Alice has {client.ledger.balanceOf(alice.address)} gold.")
+    print(f"Bob has {client.ledger.balanceOf(bob.address)} gold.")
+    print(f"Charlie has {client.ledger.balanceOf(charlie.address)} gold.")
+    print(f"Minnie has {client.ledger.balanceOf(minnie.address)} gold.")
+    print(f"Mickey has {client.ledger.balanceOf(mickey.address)} gold.")
+    print(f"Donald has {client.ledger.balanceOf(donald.address)} gold.")
 
 
 # Showing the initial balances from Alice's perspective, for no particular reason.
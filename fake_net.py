@@ -1,13 +1,211 @@
+from collections import namedtuple
+from functools import partial
+import hashlib
+import heapq
 import json
+import math
 import random
+import threading
 from threading import Timer
+import time
+import traceback
+from types import MappingProxyType
+
+# Number of message ids each node remembers in gossip mode, before the
+# oldest start to be forgotten.
+SEEN_FILTER_CAPACITY = 10000
+SEEN_FILTER_ERROR_RATE = 0.001
+
+# Number of gossiped messages whose statistics are kept, most recent first.
+STATS_CAPACITY = 1000
+
+
+def encode_payload(o):
+    """
+    Serializes a payload once into an immutable buffer.  Objects that provide
+    a toJSON method are encoded through it.  Payloads that are already bytes
+    (e.g. from the binary codec) are sent as they are.
+    """
+    if isinstance(o, (bytes, bytearray, memoryview)):
+        return bytes(o)
+    return json.dumps(o, default=lambda x: x.toJSON() if hasattr(x, 'toJSON') else x.__dict__).encode()
+
+
+def freeze(o):
+    """
+    Makes a read-only view of a decoded payload, so that it can safely be
+    shared between recipients.
+    """
+    if isinstance(o, dict):
+        return MappingProxyType({k: freeze(v) for k, v in o.items()})
+    if isinstance(o, list):
+        return tuple(freeze(v) for v in o)
+    return o
+
+
+class MessageScheduler:
+    """
+    Delivers messages from one loop, in order of delivery time, instead of
+    starting a thread per message.
+
+    With virtual_time, nothing happens until run() is called, and the clock
+    jumps straight to each delivery time, so simulations run as fast as the
+    handlers allow.  Otherwise a single daemon thread delivers each message
+    when the real clock reaches its delivery time.
+
+    Times are in the same units as the delays passed to schedule().
+    Messages due at the same time are delivered in the order they were sent.
+    """
+    def __init__(self, virtual_time=False):
+        self.virtual_time = virtual_time
+        self.queue = []
+        self.seq = 0
+        self.virtual_now = 0
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def now(self):
+        return self.virtual_now if self.virtual_time else time.monotonic()
+
+    def schedule(self, delay, callback):
+        """
+        Schedules callback to be called after delay.
+
+        :param delay: how long to wait before calling callback
+        :param callback: function taking no arguments
+        """
+        with self.condition:
+            heapq.heappush(self.queue, (self.now() + delay, self.seq, callback))
+            self.seq += 1
+            self.condition.notify()
+            if not self.virtual_time and self.thread is None:
+                self.thread = threading.Thread(target=self._deliver_forever, daemon=True)
+                self.thread.start()
+
+    def run(self, until=None):
+        """
+        Delivers queued messages in virtual time until the queue is empty, or
+        until the next message is due after the given time.
+
+        :param until: virtual time to stop at, or None to run until idle
+        :return: the number of messages delivered
+        """
+        delivered = 0
+        while True:
+            with self.condition:
+                if not self.queue or (until is not None and self.queue[0][0] > until):
+                    break
+                deliver_at, _, callback = heapq.heappop(self.queue)
+                self.virtual_now = max(self.virtual_now, deliver_at)
+            callback()
+            delivered += 1
+        if until is not None:
+            self.virtual_now = max(self.virtual_now, until)
+        return delivered
+
+    def _deliver_forever(self):
+        while True:
+            with self.condition:
+                while not self.queue or self.queue[0][0] > time.monotonic():
+                    timeout = self.queue[0][0] - time.monotonic() if self.queue else None
+                    self.condition.wait(timeout)
+                _, _, callback = heapq.heappop(self.queue)
+            # A failing handler must not stop delivery to everyone else.
+            try:
+                callback()
+            except Exception:
+                traceback.print_exc()
+
+
+class RotatingBloomFilter:
+    """
+    Remembers recently seen keys in bounded memory, as two Bloom filters.  Keys are added to the current filter, and
+    once it holds capacity keys the previous filter is dropped and the current one takes its place.  A key is
+    therefore remembered for at least capacity insertions, and false positives are possible.
+    """
+    def __init__(self, capacity=SEEN_FILTER_CAPACITY, error_rate=SEEN_FILTER_ERROR_RATE):
+        """
+        :param capacity: number of keys added before the filters rotate.
+        :param error_rate: chance of a false positive in a full filter.
+        """
+        self.capacity = capacity
+        self.bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.bits / capacity * math.log(2)))
+        self.current = bytearray((self.bits + 7) // 8)
+        self.previous = bytearray(len(self.current))
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.sha256(key).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hash_count)]
+
+    @staticmethod
+    def _test(bits, positions):
+        return all(bits[i >> 3] & (1 << (i & 7)) for i in positions)
+
+    def __contains__(self, key):
+        positions = self._positions(key)
+        return self._test(self.current, positions) or self._test(self.previous, positions)
+
+    def add(self, key):
+        if self.count >= self.capacity:
+            self.previous = self.current
+            self.current = bytearray(len(self.previous))
+            self.count = 0
+        for i in self._positions(key):
+            self.current[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+
+# Delay and chance of loss of a link between two nodes in gossip mode.
+Link = namedtuple('Link', ['delay', 'loss'])
+
+
+class GossipStats:
+    """
+    Traffic and propagation of one message broadcast in gossip mode.
+    """
+    def __init__(self, start, nodes):
+        """
+        :param start: time at which the message was broadcast.
+        :param nodes: number of nodes other than the sender.
+        """
+        self.start = start
+        self.nodes = nodes
+        self.messages = 0
+        self.bytes = 0
+        self.duplicates = 0
+        self.arrivals = []
+
+    def time_to_reach(self, fraction):
+        """
+        :return: time until the given fraction of the other nodes had received the message, or None if they never did.
+        """
+        needed = max(1, math.ceil(fraction * self.nodes))
+        if len(self.arrivals) < needed:
+            return None
+        return sorted(self.arrivals)[needed - 1]
+
+    def summary(self):
+        return {
+            'messages': self.messages,
+            'bytes': self.bytes,
+            'duplicates': self.duplicates,
+            'reached': len(self.arrivals),
+            'p50': self.time_to_reach(0.5),
+            'p90': self.time_to_reach(0.9),
+            'p100': self.time_to_reach(1.0),
+        }
 
 
 class FakeNet:
     """
     Simulates a network by using events to enable simpler testing.
     """
-    def __init__(self, chance_message_fails=0, message_delay=0):
+    def __init__(self, chance_message_fails=0, message_delay=0, scheduler=None, seed=None, share_payloads=False,
+                 fanout=None, seen_capacity=SEEN_FILTER_CAPACITY, stats_capacity=STATS_CAPACITY):
         """
         Specifies a chance of a message failing to be sent and the maximum delay of a message (in milliseconds) if it is sent.
 
@@ -15,12 +213,34 @@ class FakeNet:
 
         The message_delay parameter is the maximum -- a message may be delayed any amount of time between 0 ms and the delay specified.
 
+        Passing a MessageScheduler delivers every message from its single loop rather than from a Timer thread per
+        message.  Together with a seed, delays, drops and delivery order are then reproducible.
+
         :param chance_message_fails: Should be in the range of 0 to 1.
         :param message_delay: Time that a message may be delayed.
+        :param scheduler: optional MessageScheduler used to deliver messages.
+        :param seed: optional seed for the random delays and message failures.
+        :param share_payloads: if True, recipients of a broadcast share one read-only copy of the payload instead of
+            each decoding their own.
+        :param fanout: if set, the network runs in gossip mode: each client connects to this many random peers when
+            it registers, and a broadcast is relayed from node to node rather than sent to every client directly.
+            Each link gets its own delay, up to message_delay, and loses messages with chance_message_fails.
+        :param seen_capacity: number of message ids each node remembers in gossip mode to suppress duplicates.
+        :param stats_capacity: number of recent gossiped messages to keep statistics for, or 0 to keep none.
         """
         self.clients = {}
         self.chance_message_fails = chance_message_fails
         self.message_delay_max = message_delay
+        self.scheduler = scheduler
+        self.random = random.Random(seed)
+        self.share_payloads = share_payloads
+        self.fanout = fanout
+        self.seen_capacity = seen_capacity
+        self.stats_capacity = stats_capacity
+        self.links = {}
+        self.seen = {}
+        # Statistics by message id, oldest first.
+        self.stats = {}
 
     def register(self, *client_list):
         """
@@ -29,17 +249,95 @@ class FakeNet:
         :param client_list: clients to be registered to this network (may be Client or Miner)
         """
         for client in client_list:
+            if self.fanout and client.address not in self.clients:
+                peers = self.random.sample(list(self.clients), min(self.fanout, len(self.clients)))
+                self.links[client.address] = {}
+                self.seen[client.address] = RotatingBloomFilter(self.seen_capacity)
+                for peer in peers:
+                    self.connect(client.address, peer)
             self.clients[client.address] = client
 
-    def broadcast(self, msg, o):
+    def connect(self, a, b, delay=None, loss=None):
+        """
+        Links two nodes in gossip mode.
+
+        :param delay: delay of messages over the link, by default random up to message_delay.
+        :param loss: chance of a message over the link being lost, by default chance_message_fails.
+        """
+        link = Link(self.random.randint(0, self.message_delay_max) if delay is None else delay,
+                    self.chance_message_fails if loss is None else loss)
+        self.links[a][b] = link
+        self.links[b][a] = link
+
+    def broadcast(self, msg, o, sender=None):
         """
         Broadcasts to all clients within self.clients the message msg and payload o.
 
+        In gossip mode, the message is sent to the sender's peers, and every node relays it to its own peers the first
+        time it sees it.
+
         :param msg: the name of the event being broadcasted (e.g. "PROOF_FOUND")
         :param o: payload of the message
+        :param sender: address of the broadcasting client, required in gossip mode.
+        :return: in gossip mode, the id of the message, under which self.stats holds its statistics while it is
+            among the last stats_capacity messages.
+        """
+        # Serializing once, no matter how many clients receive the message.
+        buf = encode_payload(o)
+        if isinstance(o, (bytes, bytearray, memoryview)):
+            # Immutable, so every recipient can share a view of it.
+            decode = partial(memoryview, buf)
+        elif self.share_payloads:
+            shared = freeze(json.loads(buf))
+
+            def decode():
+                return shared
+        else:
+            decode = partial(json.loads, buf)
+        if self.fanout:
+            return self.gossip(sender, msg, buf, decode)
+        for client in list(self.clients.values()):
+            self.deliver(client.address, msg, decode)
+
+    def gossip(self, sender, msg, buf, decode):
+        if sender not in self.links:
+            raise ValueError(f"Broadcasts in gossip mode need a registered sender, got {sender}.")
+        message_id = hashlib.sha256(msg.encode() + buf).digest()
+        if self.stats_capacity:
+            self.stats.pop(message_id, None)
+            self.stats[message_id] = GossipStats(self.now(), len(self.clients) - 1)
+            while len(self.stats) > self.stats_capacity:
+                del self.stats[next(iter(self.stats))]
+        self.seen[sender].add(message_id)
+        self.relay(sender, None, message_id, msg, len(buf), decode)
+        return message_id
+
+    def relay(self, address, came_from, message_id, msg, size, decode):
+        """
+        Sends a gossiped message over each link of a node, except the one it arrived on.
         """
-        for client in self.clients.values():
-            self.send_message(client.address, msg, o)
+        stats = self.stats.get(message_id)
+        for peer, link in self.links[address].items():
+            if peer == came_from:
+                continue
+            if stats is not None:
+                stats.messages += 1
+                stats.bytes += size
+            if self.random.random() > link.loss:
+                self.schedule(link.delay, partial(self.arrive, peer, address, message_id, msg, size, decode))
+
+    def arrive(self, address, came_from, message_id, msg, size, decode):
+        stats = self.stats.get(message_id)
+        seen = self.seen[address]
+        if message_id in seen:
+            if stats is not None:
+                stats.duplicates += 1
+            return
+        seen.add(message_id)
+        if stats is not None:
+            stats.arrivals.append(self.now() - stats.start)
+        self.clients[address].emit(msg, decode())
+        self.relay(address, came_from, message_id, msg, size, decode)
 
     def send_message(self, address, msg, o):
         """
@@ -55,22 +353,47 @@ class FakeNet:
             raise TypeError(f"Expecting an object, but got a {type(o)}")
 
         # Serializing/deserializing the object to prevent cheating in single threaded mode.
-        o2 = json.loads(json.dumps(o))
+        buf = encode_payload(o)
+        if isinstance(o, (bytes, bytearray, memoryview)):
+            self.deliver(address, msg, partial(memoryview, buf))
+        else:
+            self.deliver(address, msg, partial(json.loads, buf))
+
+    def deliver(self, address, msg, decode):
+        """
+        Delivers an already serialized message, subject to the delays and failures of this network.  The payload is
+        only decoded once the message arrives.
 
+        :param address: the public key address of the recipient
+        :param msg: the name of the event being sent
+        :param decode: function returning the recipient's copy of the payload
+        """
         client = self.clients.get(address)
+        if client is None:
+            # Nobody is listening at that address, so the message is lost.
+            return
 
-        delay = random.randint(0, self.message_delay_max)
+        delay = self.random.randint(0, self.message_delay_max)
 
-        if random.random() > self.chance_message_fails:
+        if self.random.random() > self.chance_message_fails:
             def emit_message():
-                client.emit(msg, o2)
-            Timer(delay, emit_message).start()
+                client.emit(msg, decode())
+            self.schedule(delay, emit_message)
+
+    def schedule(self, delay, callback):
+        if self.scheduler:
+            self.scheduler.schedule(delay, callback)
+        else:
+            Timer(delay, callback).start()
+
+    def now(self):
+        return self.scheduler.now() if self.scheduler else time.monotonic()
 
     def recognizes(self, client):
         """
         Tests whether a client is registered with the network.
 
-        :param client: the client to test for.
+        :param client: the client, or its address, to test for.
         :return: True if the client is already registered.
         """
-        return client.address in self.clients
+        return getattr(client, 'address', client) in self.clients
@@ -0,0 +1,207 @@
+from collections.abc import MutableMapping
+
+# Once a chain of layers gets this deep, a new layer flattens its parent into
+# a plain dict, so lookups never walk more than this many layers.
+FLATTEN_DEPTH = 32
+
+# Marks an account deleted in a layer, hiding any value in the parents.
+_DELETED = object()
+
+
+class LedgerState(MutableMapping):
+    """
+    Account state (balances or nonces) stored as a layer of changes over the
+    parent block's state.  Creating a child is O(1), and the child only
+    stores the accounts that are written to it, so a chain of blocks shares
+    one copy of every account that it did not touch.
+
+    A parent must not be modified once it has children.
+    """
+
+    def __init__(self, parent=None):
+        if isinstance(parent, LedgerState) and parent.depth >= FLATTEN_DEPTH:
+            parent = parent.flatten()
+        self.parent = parent
+        self.depth = parent.depth + 1 if isinstance(parent, LedgerState) else 1
+        self.changes = {}
+
+    def __getitem__(self, key):
+        state = self
+        while isinstance(state, LedgerState):
+            value = state.changes.get(key, state)
+            if value is _DELETED:
+                raise KeyError(key)
+            if value is not state:
+                return value
+            state = state.parent
+        if state is None:
+            raise KeyError(key)
+        return state[key]
+
+    def __setitem__(self, key, value):
+        self.changes[key] = value
+
+    def __delitem__(self, key):
+        self[key]
+        self.changes[key] = _DELETED
+
+    def __iter__(self):
+        return iter(self.flatten())
+
+    def __len__(self):
+        return len(self.flatten())
+
+    def copy(self):
+        """
+        Returns a copy-on-write child of this state.
+        """
+        return LedgerState(self)
+
+    def flatten(self) -> dict:
+        """
+        Materializes the full state as a plain dict.
+        """
+        layers = []
+        state = self
+        while isinstance(state, LedgerState):
+            layers.append(state.changes)
+            state = state.parent
+        flat = dict(state) if state is not None else {}
+        for changes in reversed(layers):
+            flat.update(changes)
+        return {k: v for k, v in flat.items() if v is not _DELETED}
+
+
+# Marks an account that did not exist before a block touched it.
+_MISSING = object()
+
+
+class Ledger:
+    """
+    One mutable copy of the account balances and nonces, for the block at
+    the tip of a client's chain.
+
+    Applying a block records an undo log holding the previous balance and
+    nonce of every account it touched.  Switching to another fork undoes
+    blocks back to the common ancestor and then applies the new branch, so
+    the cost depends on the blocks involved, not on the number of accounts.
+    Only the undo logs of the last maxUndo blocks are kept, so the ledger
+    cannot move to a fork that branched off below them.
+    """
+
+    def __init__(self, genesis, maxUndo=None):
+        self.balances = dict(genesis.balances)
+        self.nextNonce = dict(genesis.nextNonce)
+        self.tipId = genesis.id
+        self.maxUndo = maxUndo
+        # Undo logs by block id, oldest first.
+        self.undoLogs = {}
+
+    def balanceOf(self, addr):
+        return self.balances.get(addr, 0.0)
+
+    def balanceAt(self, addr, depth):
+        """
+        Balance of addr as of the block depth blocks below the tip, read back
+        through the undo logs of the blocks above it.
+        """
+        if depth > len(self.undoLogs):
+            raise ValueError(f"No undo logs for {depth} blocks below the tip.")
+        balance = self.balances.get(addr, _MISSING)
+        for balanceUndo, _ in list(self.undoLogs.values())[len(self.undoLogs) - depth:]:
+            # The oldest block that touched the account holds its earlier value.
+            if addr in balanceUndo:
+                balance = balanceUndo[addr]
+                break
+        return 0.0 if balance is _MISSING else balance
+
+    def apply(self, block, prevBlock) -> bool:
+        """
+        Applies block on top of the current tip, which must be prevBlock.
+        Signatures are not checked; the block must already have been
+        validated.  On failure the ledger is left unchanged.
+        """
+        if block.prevBlockHash != self.tipId:
+            raise ValueError(f"Block does not extend the ledger tip {self.tipId}.")
+        balanceUndo = {}
+        nonceUndo = {}
+
+        def setBalance(addr, value):
+            if addr not in balanceUndo:
+                balanceUndo[addr] = self.balances.get(addr, _MISSING)
+            self.balances[addr] = value
+
+        if prevBlock.rewardAddr:
+            setBalance(prevBlock.rewardAddr, self.balanceOf(prevBlock.rewardAddr) + prevBlock.totalRewards())
+
+        for tx in block.transactions.values():
+            sender = tx.from_address
+            nonce = self.nextNonce.get(sender, 0)
+            if tx.nonce != nonce or tx.total_output() > self.balanceOf(sender):
+                self._restore(balanceUndo, nonceUndo)
+                return False
+            if sender not in nonceUndo:
+                nonceUndo[sender] = self.nextNonce.get(sender, _MISSING)
+            self.nextNonce[sender] = nonce + 1
+            setBalance(sender, self.balanceOf(sender) - tx.total_output())
+            for output in tx.outputs:
+                setBalance(output['address'], self.balanceOf(output['address']) + output['amount'])
+
+        self.tipId = block.id
+        self.undoLogs[self.tipId] = (balanceUndo, nonceUndo)
+        if self.maxUndo is not None and len(self.undoLogs) > self.maxUndo:
+            del self.undoLogs[next(iter(self.undoLogs))]
+        return True
+
+    def undo(self, block):
+        """
+        Rolls back the block at the tip of the ledger.
+        """
+        if block.id != self.tipId:
+            raise ValueError(f"Block is not the ledger tip {self.tipId}.")
+        self._restore(*self.undoLogs.pop(self.tipId))
+        self.tipId = block.prevBlockHash
+
+    def canReorg(self, newTipId, index) -> bool:
+        """
+        Whether the undo logs reach back to the common ancestor of the tip
+        and newTipId.
+        """
+        ancestor = index.commonAncestor(self.tipId, newTipId)
+        return index.height(self.tipId) - index.height(ancestor) <= len(self.undoLogs)
+
+    def reorg(self, newTipId, blocks, index) -> bool:
+        """
+        Moves the ledger to newTipId: undoes blocks back to the common
+        ancestor with the current tip, then applies the new branch.
+
+        :param blocks: Mapping of block ids to blocks.
+        :param index: BlockIndex containing both tips.
+        :return: False if a block on the new branch could not be applied, in
+            which case the ledger is left at the last block that applied.
+        :raises ValueError: if the undo logs do not reach the common ancestor.
+        """
+        if not self.canReorg(newTipId, index):
+            raise ValueError(f"Cannot undo back to the common ancestor of {newTipId}.")
+        ancestor = index.commonAncestor(self.tipId, newTipId)
+        while self.tipId != ancestor:
+            self.undo(blocks[self.tipId])
+
+        branch = []
+        blockId = newTipId
+        while blockId != ancestor:
+            branch.append(blockId)
+            blockId = index.parent(blockId)
+        for blockId in reversed(branch):
+            block = blocks[blockId]
+            if not self.apply(block, blocks[block.prevBlockHash]):
+                return False
+        return True
+
+    def _restore(self, balanceUndo, nonceUndo):
+        for state, undo in ((self.balances, balanceUndo), (self.nextNonce, nonceUndo)):
+            for addr, value in undo.items():
+                if value is _MISSING:
+                    del state[addr]
+                else:
+                    state[addr] = value
@@ -0,0 +1,125 @@
+import heapq
+
+from utils import LazyHeap
+
+# Maximum number of pending transactions a miner keeps.
+DEFAULT_MAX_SIZE = 10000
+
+
+def feeRate(tx) -> float:
+    """
+    Fee paid per byte of the transaction's payload.
+    """
+    return tx.fee / len(tx.payload)
+
+
+class Mempool:
+    """
+    Pending transactions, indexed by id and by sender and nonce.
+
+    Transactions whose nonce is ahead of the sender's next nonce are held
+    until their predecessors arrive.  When the pool is full, the transaction
+    with the lowest fee rate is evicted.
+    """
+
+    def __init__(self, maxSize=DEFAULT_MAX_SIZE):
+        self.maxSize = maxSize
+        self.txs = {}
+        self.bySender = {}
+
+        # Transaction ids by fee rate, used for eviction.
+        self.feeHeap = LazyHeap(self.txs)
+
+    def __len__(self):
+        return len(self.txs)
+
+    def __contains__(self, tx):
+        return tx.id in self.txs
+
+    def __iter__(self):
+        return iter(list(self.txs.values()))
+
+    def add(self, tx) -> bool:
+        """
+        Adds a transaction.  A transaction with the same sender and nonce as a
+        pending one replaces it only if it pays a higher fee rate.
+
+        :return: True if the transaction is now in the pool.
+        """
+        if tx.id in self.txs:
+            return False
+        nonces = self.bySender.setdefault(tx.from_address, {})
+        existing = nonces.get(tx.nonce)
+        if existing is not None:
+            if feeRate(tx) <= feeRate(existing):
+                return False
+            self.remove(existing)
+            nonces = self.bySender.setdefault(tx.from_address, {})
+
+        self.txs[tx.id] = tx
+        nonces[tx.nonce] = tx
+        self.feeHeap.push(feeRate(tx), tx.id)
+
+        while len(self.txs) > self.maxSize:
+            self.evict()
+        return tx.id in self.txs
+
+    def remove(self, tx) -> bool:
+        if self.txs.pop(tx.id, None) is None:
+            return False
+        nonces = self.bySender[tx.from_address]
+        del nonces[tx.nonce]
+        if not nonces:
+            del self.bySender[tx.from_address]
+        self.feeHeap.compact()
+        return True
+
+    def find(self, sender, nonce):
+        """
+        Returns the pending transaction of a sender with the given nonce, or None.
+        """
+        return self.bySender.get(sender, {}).get(nonce)
+
+    def removeConfirmed(self, txs):
+        """
+        Drops transactions that were included in a block, along with any
+        pending transactions whose nonces they have used up, including other
+        transactions with the same nonce.
+        """
+        for tx in txs:
+            self.remove(tx)
+            for nonce in [n for n in self.bySender.get(tx.from_address, ()) if n <= tx.nonce]:
+                self.remove(self.bySender[tx.from_address][nonce])
+
+    def evict(self):
+        """
+        Removes the pending transaction with the lowest fee rate.
+        """
+        txId = self.feeHeap.pop()
+        if txId is None:
+            return None
+        tx = self.txs[txId]
+        self.remove(tx)
+        return tx
+
+    def select(self, nextNonce):
+        """
+        Yields transactions ready to go into a block, highest fee rate first,
+        with each sender's transactions in nonce order.  A sender's next
+        transaction only becomes a candidate once the previous one is taken.
+
+        :param nextNonce: Function returning the next expected nonce for a sender.
+        """
+        candidates = []
+        for sender, nonces in list(self.bySender.items()):
+            tx = nonces.get(nextNonce(sender))
+            if tx is not None:
+                candidates.append((-feeRate(tx), tx.id, tx))
+        heapq.heapify(candidates)
+
+        while candidates:
+            _, _, tx = heapq.heappop(candidates)
+            yield tx
+            following = self.bySender.get(tx.from_address, {}).get(tx.nonce + 1)
+            if following is not None:
+                heapq.heappush(candidates, (-feeRate(following), following.id, following))
@@ -0,0 +1,110 @@
+import hashlib
+
+# Leaves and interior nodes are hashed with different prefixes, so a leaf
+# can never be passed off as an interior node.
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+EMPTY_ROOT = bytes(32)
+
+
+def hashLeaf(leaf: bytes) -> bytes:
+    return hashlib.sha256(LEAF_PREFIX + leaf).digest()
+
+
+def hashNode(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+class MerkleTree:
+    """
+    A Merkle tree that is updated as leaves are appended.  Appending only
+    rehashes the path from the new leaf to the root, so building the tree
+    one leaf at a time costs O(n log n) in total.
+
+    A node without a sibling is promoted to the next level unchanged.
+    """
+
+    def __init__(self, leaves=()):
+        self.levels = [[]]
+        self.positions = {}
+        self.extend(leaves)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def __contains__(self, leaf):
+        return leaf in self.positions
+
+    def append(self, leaf: bytes):
+        i = len(self.levels[0])
+        self.positions[leaf] = i
+        self.levels[0].append(hashLeaf(leaf))
+
+        level = 0
+        while len(self.levels[level]) > 1:
+            nodes = self.levels[level]
+            i //= 2
+            if 2 * i + 1 < len(nodes):
+                parentHash = hashNode(nodes[2 * i], nodes[2 * i + 1])
+            else:
+                parentHash = nodes[2 * i]
+            if level + 1 == len(self.levels):
+                self.levels.append([])
+            parents = self.levels[level + 1]
+            if i < len(parents):
+                parents[i] = parentHash
+            else:
+                parents.append(parentHash)
+            level += 1
+
+    def extend(self, leaves):
+        """
+        Appends many leaves.  Into an empty tree they are hashed level by
+        level, which needs only O(n) hashes.
+        """
+        if self.levels[0]:
+            for leaf in leaves:
+                self.append(leaf)
+            return
+        # Same hashes as hashLeaf and hashNode, without a call per node.
+        sha256 = hashlib.sha256
+        leaves = list(leaves)
+        self.positions = {leaf: i for i, leaf in enumerate(leaves)}
+        nodes = [sha256(LEAF_PREFIX + leaf).digest() for leaf in leaves]
+        self.levels = [nodes]
+        while len(nodes) > 1:
+            nodes = [sha256(NODE_PREFIX + nodes[i] + nodes[i + 1]).digest() if i + 1 < len(nodes) else nodes[i]
+                     for i in range(0, len(nodes), 2)]
+            self.levels.append(nodes)
+
+    def root(self) -> bytes:
+        return self.levels[-1][0] if self.levels[0] else EMPTY_ROOT
+
+    def proof(self, leaf: bytes):
+        """
+        Builds an inclusion proof for a leaf.
+
+        :return: List of (sibling hash, sibling is on the left) pairs from
+            the leaf up to the root, or None if the leaf is not in the tree.
+        """
+        i = self.positions.get(leaf)
+        if i is None:
+            return None
+        path = []
+        for nodes in self.levels[:-1]:
+            sibling = i ^ 1
+            if sibling < len(nodes):
+                path.append((nodes[sibling], sibling < i))
+            i //= 2
+        return path
+
+
+def verifyProof(leaf: bytes, proof, root: bytes) -> bool:
+    """
+    Checks that a leaf is committed to by the given root.
+    """
+    h = hashLeaf(leaf)
+    for sibling, siblingOnLeft in proof:
+        h = hashNode(sibling, h) if siblingOnLeft else hashNode(h, sibling)
+    return h == root
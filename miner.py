@@ -1,14 +1,33 @@
+from functools import partial
+import time
+
 from block import Block
 import blockchain
 from client import Client
+import codec
+from mempool import Mempool
+import merkle
+from mining import ProofSearch, ParallelProofSearch
+from transaction import Transaction
+import utils
 
 
 class Miner(Client):
     def __init__(self, name=None, net=None, startingBlock: Block = None, keyPair=None,
-                 miningRounds=blockchain.NUM_ROUNDS_MINING):
-        super().__init__(name=name, net=net, startingBlock=startingBlock, keyPair=keyPair)
+                 miningRounds=blockchain.NUM_ROUNDS_MINING, miningWorkers=0, difficulty=None, verifyExecutor=None):
+        super().__init__(name=name, net=net, startingBlock=startingBlock, keyPair=keyPair, difficulty=difficulty,
+                         verifyExecutor=verifyExecutor)
         self.miningRounds = miningRounds
-        self.transactions = set()
+        self.transactions = Mempool()
+        self.currentBlock = None
+        self.templateTouches = {}
+
+        # With miningWorkers > 0, each round searches miningRounds nonces
+        # per worker process instead of on the event thread.
+        self.parallelSearch = ParallelProofSearch(miningWorkers) if miningWorkers else None
+        self.searching = False
+        self.hashCount = 0
+        self.hashTime = 0.0
 
     def initialize(self):
         self.startNewSearch()
@@ -17,51 +36,273 @@ class Miner(Client):
         self.emit(blockchain.START_MINING)
 
     def startNewSearch(self, txSet=None):
-        self.currentBlock = blockchain.makeBlock(self.address, self.lastBlock)
-        txSet = set() if txSet is None else txSet
-        for tx in txSet:
+        """
+        Starts mining a new block on top of lastBlock, filled from the
+        pending pool.  Their signatures were checked when they were first
+        added, so only the nonce and balance checks run here.  After a
+        cutover the template is updated by updateTemplate instead.
+        """
+        self.cancelSearch()
+        self.newTemplate()
+        for tx in txSet or ():
+            self.transactions.add(tx)
+        nextNonce = self.currentBlock.nextNonce
+        for tx in self.transactions.select(lambda sender: nextNonce.get(sender, 0)):
+            self.includeTransaction(tx)
+        self.transactions.removeConfirmed(self.currentBlock.transactions.values())
+
+    def newTemplate(self):
+        # The template is built on the ledger rather than on lastBlock's own
+        # state, which blocks read from a block store or the wire lack.
+        self.currentBlock = Block(self.address, self.lastBlock,
+                                  balances=self.ledger.balances, nextNonce=self.ledger.nextNonce)
+        self.currentBlock.target = self.difficulty.nextTarget(self.lastBlock.id, self.blocks, self.blockIndex)
+        self.currentBlock.timestamp = self.templateTime()
+        # Template transactions by the accounts they touch, in block order,
+        # so that a cutover only rechecks the accounts whose state changed.
+        self.templateTouches = {}
+
+    def templateTime(self):
+        # Our clock may be behind the chain's, but the block must still be
+        # later than the median time past to be valid.
+        return max(int(utils.now() * 1000),
+                   self.difficulty.medianTimePast(self.lastBlock.id, self.blocks, self.blockIndex) + 1)
+
+    def includeTransaction(self, tx) -> bool:
+        if not self.currentBlock.addTransaction(tx, self):
+            return False
+        for account in accountsOf(tx):
+            self.templateTouches.setdefault(account, []).append(tx)
+        return True
+
+    def dropTransaction(self, tx):
+        del self.currentBlock.transactions[tx.id]
+        for account in accountsOf(tx):
+            touches = self.templateTouches[account]
+            touches.remove(tx)
+            if not touches:
+                del self.templateTouches[account]
+
+    def updateTemplate(self, confirmed, orphaned, touched):
+        """
+        Moves the block template onto the new lastBlock after a cutover.
+        Transactions confirmed by the new chain are taken out, and only the
+        template transactions of accounts whose balance or nonce changed are
+        checked again; the others keep the results of their earlier checks.
+        Transactions orphaned by the re-org, or dropped from the template,
+        go back to the pending pool, and the pool is searched only for the
+        accounts involved.  Apart from rehashing the transactions root when
+        transactions were taken out, the work depends on the size of the
+        chain difference, not of the pool.
+
+        :param confirmed: transactions on the new branch, by id.
+        :param orphaned: transactions only on the abandoned branch.
+        :param touched: accounts whose ledger state the re-org changed.
+        """
+        self.cancelSearch()
+        block = self.currentBlock
+        affected = set(touched)
+        if block.id in self.blockIndex:
+            # We found this block ourselves, so it is now part of the chain.
+            self.newTemplate()
+            affected.add(self.address)
+        else:
+            block.prevBlockHash = self.lastBlock.id
+            block.chainLength = self.lastBlock.chainLength + 1
+            block.target = self.difficulty.nextTarget(self.lastBlock.id, self.blocks, self.blockIndex)
+            block.timestamp = self.templateTime()
+            block.proof = 0
+            size = len(block.transactions)
+            for tx in confirmed.values():
+                if tx.id in block.transactions:
+                    self.dropTransaction(tx)
+            affected = self.recheckTemplate(affected)
+            if len(block.transactions) != size:
+                block.txTree = merkle.MerkleTree(bytes.fromhex(txId) for txId in block.transactions)
+
+        for tx in orphaned:
             self.transactions.add(tx)
-        for tx in self.transactions:
-            self.currentBlock.addTransaction(tx, self)
-        self.transactions.clear()
-        self.currentBlock.proof = 0
+        self.fillTemplate(affected)
+
+    def recheckTemplate(self, accounts):
+        """
+        Reruns the nonce and balance checks of the template transactions
+        touching the given accounts against the new parent state.  A
+        transaction that fails goes back to the pending pool if its nonce
+        may still be used, and the accounts it paid are checked in turn.
+
+        :return: every account that was checked.
+        """
+        block = self.currentBlock
+        accounts = set(accounts)
+        checked = set()
+        while accounts:
+            account = accounts.pop()
+            checked.add(account)
+            balance = self.ledger.balanceOf(account)
+            if self.lastBlock.rewardAddr == account:
+                balance += self.lastBlock.totalRewards()
+            base = nonce = self.ledger.nextNonce.get(account, 0)
+            for tx in list(self.templateTouches.get(account, ())):
+                if tx.from_address == account:
+                    if tx.nonce != nonce or tx.total_output() > balance:
+                        self.dropTransaction(tx)
+                        if tx.nonce >= base:
+                            self.transactions.add(tx)
+                        accounts.update(output['address'] for output in tx.outputs)
+                        continue
+                    nonce += 1
+                    balance -= tx.total_output()
+                balance += sum(output['amount'] for output in tx.outputs if output['address'] == account)
+            block.balances[account] = balance
+            if nonce != base:
+                block.nextNonce[account] = nonce
+            else:
+                block.nextNonce.changes.pop(account, None)
+        return checked
+
+    def fillTemplate(self, accounts):
+        """
+        Moves pending transactions of the given accounts into the template,
+        in nonce order, along with those they make affordable.
+        """
+        accounts = set(accounts)
+        while accounts:
+            account = accounts.pop()
+            tx = self.transactions.find(account, self.currentBlock.nextNonce.get(account, 0))
+            while tx is not None and self.includeTransaction(tx):
+                self.transactions.remove(tx)
+                accounts.update(output['address'] for output in tx.outputs)
+                tx = self.transactions.find(account, tx.nonce + 1)
+
+    def addTransaction(self, tx):
+        """
+        Adds a posted transaction to the pending pool, and to the block
+        template straight away if the sender's earlier transactions are in.
+        """
+        tx = Transaction.deserialize(tx)
+        if not tx.valid_signature():
+            self.log(f"Invalid signature for transaction {tx.id}.")
+            return
+        if self.transactions.add(tx) and self.currentBlock:
+            self.fillTemplate([tx.from_address])
 
     def findProof(self, oneAndDone=False):
-        pausePoint = self.currentBlock.proof + self.miningRounds
-        while self.currentBlock.proof < pausePoint:
-            if self.currentBlock.hasValidProof():
-                print(f'found proof for block {self.currentBlock.chainLength}: {self.currentBlock.proof}')
+        # The header prefix is fixed for this round; only the proof changes.
+        currentBlock = self.currentBlock
+        header = currentBlock.header
+        prefix = header.prefix()
+        start = time.perf_counter()
+        self.searching = True
+        try:
+            if self.parallelSearch:
+                proof, hashes = self.parallelSearch.search(prefix, header.target,
+                                                           currentBlock.proof, self.miningRounds)
+                rounds = self.miningRounds * self.parallelSearch.workers
+            else:
+                search = ProofSearch(prefix, header.target)
+                proof = search.search(currentBlock.proof, self.miningRounds)
+                hashes = search.hashes
+                rounds = self.miningRounds
+        finally:
+            self.searching = False
+        self.hashTime += time.perf_counter() - start
+        self.hashCount += hashes
+
+        # The template is updated in place when we cut over to a new chain or
+        # take in a transaction, so a result for another header is stale.
+        if currentBlock is self.currentBlock and currentBlock.header.prefix() == prefix:
+            if proof is None:
+                currentBlock.proof += rounds
+            else:
+                currentBlock.proof = proof
+                print(f'found proof for block {currentBlock.chainLength}: {currentBlock.proof}')
                 self.announceProof()
-                self.receiveBlock(self.currentBlock)
-                break
-            self.currentBlock.proof += 1
+                self.receiveBlock(currentBlock)
         if not oneAndDone:
-            self.emit(blockchain.START_MINING)
+            # Let pending messages through before the next round, rather than
+            # starting it from within this one.
+            self.net.schedule(0, partial(self.emit, blockchain.START_MINING))
+
+    def cancelSearch(self):
+        """
+        Stops the worker search in progress, if any.  A cancel stays pending
+        until the next search otherwise, so it is only sent mid-search.
+        """
+        if self.parallelSearch and self.searching:
+            self.parallelSearch.cancel()
+
+    def shutdown(self):
+        """
+        Stops the mining worker processes, if any.  Mining continues on the
+        event thread if findProof is called again.
+        """
+        if self.parallelSearch:
+            self.parallelSearch.shutdown()
+            self.parallelSearch = None
+
+    @property
+    def hashRate(self):
+        """
+        Hashes per second, summed over all mining workers.
+        """
+        return self.hashCount / self.hashTime if self.hashTime else 0.0
 
     def announceProof(self):
-        self.net.broadcast(blockchain.PROOF_FOUND, self.currentBlock)
+        self.net.broadcast(blockchain.COMPACT_BLOCK, codec.encodeCompactBlock(self.currentBlock), sender=self.address)
 
-    def receiveBlock(self, s):
-        b = super().receiveBlock(s)
+    def receiveBlock(self, s, requestMissing=True):
+        oldTip = self.lastBlock
+        b = super().receiveBlock(s, requestMissing)
         if b is None:
             return None
-        if self.currentBlock and b.chainLength >= self.currentBlock.chainLength:
+        # Cut over whenever the tip with the most work changed, whether to b
+        # or to an orphan connected after it.
+        if self.currentBlock and self.lastBlock.id != oldTip.id:
             print('cutting over to new chain.')
-            txSet = self.syncTransactions(b)
-            self.startNewSearch(txSet)
+            self.updateTemplate(*self.syncTransactions(self.lastBlock, oldTip))
         return b
 
-    def syncTransactions(self, nb):
-        cb = self.currentBlock
-        cbTxs = set()
-        nbTxs = set()
-        while cb is not None and cb != nb.commonAncestor:
-            for tx in cb.transactions:
-                cbTxs.add(tx)
-            cb = cb.previousBlock
-        for tx in nb.transactions:
-            nbTxs.add(tx)
-        txSet = cbTxs - nbTxs
-        for tx in txSet:
-            self.currentBlock.addTransaction(tx, self)
-        return txSet
+    def knownTransactions(self):
+        # Pending transactions and those in our own block template, which
+        # competing miners are likely to have included too.
+        return super().knownTransactions() + list(self.transactions) + \
+            list(self.currentBlock.transactions.values() if self.currentBlock else [])
+
+    def syncTransactions(self, nb, oldTip=None):
+        """
+        Updates the pending pool for a switch from oldTip to the new block nb.
+        Only the blocks between the two tips and their common ancestor are
+        visited, and the transactions they confirm are dropped from the pool.
+
+        :return: the transactions on the new branch by id, those only on the
+            abandoned branch, and the accounts whose balance or nonce
+            differs between the two tips.
+        """
+        confirmed = {}
+        orphaned = {}
+        touched = set()
+        old = oldTip or self.blocks.get(self.currentBlock.prevBlockHash)
+        ancestor = self.blockIndex.commonAncestor(old.id, nb.id) if old else None
+        if ancestor is not None:
+            # Its reward is paid by the first block of each branch.
+            touched.add(self.blocks[ancestor].rewardAddr)
+        for tip, txs in ((nb, confirmed), (old, orphaned)):
+            b = tip
+            while b is not None and b.id != ancestor:
+                txs.update(b.transactions)
+                touched.add(b.rewardAddr)
+                for tx in b.transactions.values():
+                    touched.update(accountsOf(tx))
+                b = self.blocks.get(b.prevBlockHash)
+
+        touched.discard(None)
+        self.transactions.removeConfirmed(confirmed.values())
+        return confirmed, {tx for txId, tx in orphaned.items() if txId not in confirmed}, touched
+
+
+def accountsOf(tx):
+    """
+    Accounts whose state a transaction changes.
+    """
+    return {tx.from_address} | {output['address'] for output in tx.outputs}
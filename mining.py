@@ -0,0 +1,116 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import multiprocessing
+import struct
+
+NONCE_FORMAT = struct.Struct('>Q')
+
+# How many nonces a worker tries between checks of the stop flag.
+CANCEL_CHECK_INTERVAL = 4096
+
+
+class ProofSearch:
+    """
+    Searches for a proof over a fixed header prefix.
+
+    The prefix (everything in the header except the proof) is fed to the hash
+    function once, and each attempt copies that midstate and appends only the
+    8 nonce bytes.
+    """
+
+    def __init__(self, prefix: bytes, target: int):
+        self.midstate = hashlib.sha256(prefix)
+        self.target = target
+        self.hashes = 0
+
+    def search(self, start: int, count: int):
+        """
+        Tries the nonces in [start, start + count).
+
+        :return: The first nonce that satisfies the target, or None.
+        """
+        midstate = self.midstate
+        target = self.target
+        pack = NONCE_FORMAT.pack
+        fromBytes = int.from_bytes
+        for nonce in range(start, start + count):
+            h = midstate.copy()
+            h.update(pack(nonce))
+            if fromBytes(h.digest(), 'big') < target:
+                self.hashes += nonce - start + 1
+                return nonce
+        self.hashes += count
+        return None
+
+
+
+# Set in each worker process by ParallelProofSearch.
+_stopEvent = None
+
+
+def _initWorker(stopEvent):
+    global _stopEvent
+    _stopEvent = stopEvent
+
+
+def _searchRange(prefix, target, start, count):
+    """
+    Worker entry point: searches [start, start + count), stopping early once
+    any worker has found a proof or the search was cancelled.
+
+    :return: (proof or None, number of hashes computed)
+    """
+    search = ProofSearch(prefix, target)
+    end = start + count
+    while start < end and not _stopEvent.is_set():
+        n = min(CANCEL_CHECK_INTERVAL, end - start)
+        proof = search.search(start, n)
+        if proof is not None:
+            _stopEvent.set()
+            return proof, search.hashes
+        start += n
+    return None, search.hashes
+
+
+class ParallelProofSearch:
+    """
+    Splits the nonce space across a pool of worker processes.  Each worker
+    searches a disjoint range of the same header; all of them stop as soon as
+    one finds a proof or cancel() is called.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.stopEvent = multiprocessing.Event()
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_initWorker,
+                                            initargs=(self.stopEvent,))
+
+    def search(self, prefix: bytes, target: int, start: int, count: int):
+        """
+        Searches [start, start + count * workers), giving each worker a
+        range of count nonces.
+
+        :return: (lowest proof found or None, total hashes across workers)
+        """
+        futures = [self.executor.submit(_searchRange, prefix, target, start + i * count, count)
+                   for i in range(self.workers)]
+        proof = None
+        hashes = 0
+        try:
+            for f in futures:
+                p, n = f.result()
+                hashes += n
+                if p is not None and (proof is None or p < proof):
+                    proof = p
+        finally:
+            # Reset only once every worker is done, so that a cancel() made
+            # just before the search started still stops it.
+            self.stopEvent.clear()
+        return proof, hashes
+
+    def cancel(self):
+        self.stopEvent.set()
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown()
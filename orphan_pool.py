@@ -0,0 +1,103 @@
+import time
+
+from utils import LazyHeap
+
+# Maximum number of orphaned blocks a client keeps.
+DEFAULT_MAX_ORPHANS = 1000
+
+# Seconds an orphan is kept while waiting for its parent.
+DEFAULT_MAX_AGE = 600
+
+# Eviction policies for a full pool.
+EVICT_OLDEST = 'oldest'
+EVICT_LOWEST = 'lowest'
+
+
+class OrphanPool:
+    """
+    Blocks whose parent is not known yet, indexed by id and by parent id.
+
+    The pool holds at most maxSize blocks, and drops blocks that have waited
+    longer than maxAge.  When it is full, either the block that arrived first
+    or the one with the lowest chain length is evicted, so a peer flooding us
+    with unconnected blocks cannot grow it without bound.
+    """
+
+    def __init__(self, maxSize=DEFAULT_MAX_ORPHANS, maxAge=DEFAULT_MAX_AGE, policy=EVICT_OLDEST, clock=time.monotonic):
+        if policy not in (EVICT_OLDEST, EVICT_LOWEST):
+            raise ValueError(f"Unknown eviction policy {policy}.")
+        self.maxSize = maxSize
+        self.maxAge = maxAge
+        self.policy = policy
+        self.clock = clock
+
+        # Block ids map to (block, time added), in the order they arrived.
+        self.blocks = {}
+        self.byParent = {}
+
+        # Block ids by chain length, for EVICT_LOWEST.
+        self.heightHeap = LazyHeap(self.blocks)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __contains__(self, blockId):
+        return blockId in self.blocks
+
+    def isWaitingFor(self, parentId) -> bool:
+        return parentId in self.byParent
+
+    def add(self, block) -> bool:
+        """
+        Adds an orphaned block, evicting others if the pool is full.
+
+        :return: True if the block is now in the pool.
+        """
+        self.expire()
+        if block.id in self.blocks:
+            return False
+        self.blocks[block.id] = (block, self.clock())
+        self.byParent.setdefault(block.prevBlockHash, set()).add(block.id)
+        if self.policy == EVICT_LOWEST:
+            self.heightHeap.push(block.chainLength, block.id)
+
+        while len(self.blocks) > self.maxSize:
+            self.evict()
+        return block.id in self.blocks
+
+    def remove(self, blockId):
+        entry = self.blocks.pop(blockId, None)
+        if entry is None:
+            return None
+        block = entry[0]
+        children = self.byParent[block.prevBlockHash]
+        children.discard(blockId)
+        if not children:
+            del self.byParent[block.prevBlockHash]
+        self.heightHeap.compact()
+        return block
+
+    def popChildren(self, parentId):
+        """
+        Removes and returns the blocks waiting for the given parent.
+        """
+        return [self.remove(blockId) for blockId in list(self.byParent.get(parentId, ()))]
+
+    def evict(self):
+        if self.policy == EVICT_LOWEST:
+            blockId = self.heightHeap.pop()
+            if blockId is not None:
+                self.remove(blockId)
+        elif self.blocks:
+            self.remove(next(iter(self.blocks)))
+
+    def expire(self):
+        """
+        Drops blocks that have waited longer than maxAge.
+        """
+        cutoff = self.clock() - self.maxAge
+        while self.blocks:
+            blockId, (_, added) = next(iter(self.blocks.items()))
+            if added >= cutoff:
+                break
+            self.remove(blockId)
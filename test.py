@@ -1,37 +1,120 @@
-from unittest import TestCase
+from unittest import TestCase, mock
 from hashlib import sha256
+import json
+import threading
+import time
 import utils
 import block
+import block_index
+import block_store
 import blockchain
 import client
+import codec
+import difficulty
+import fake_net
+import ledger
+import mempool
+import merkle
 import miner
+import mining
+import orphan_pool
 import transaction
 
 # Generating keypair for multiple test cases, since key generation is slow.
 kp = utils.generateKeypair()
-addr = utils.calcAddress(kp.public)
+addr = utils.calcAddress(kp["public"])
 
 # Adding a POW target that should be trivial to match.
 EASY_POW_TARGET = 2 ** 256 - 1
 
+def next_block(prev, reward_addr=addr):
+    # Spacing blocks by the target block time keeps the retargeted difficulty unchanged.
+    b = block.Block(reward_addr, prev)
+    b.timestamp = prev.timestamp + blockchain.TARGET_BLOCK_TIME
+    return b
+
+
 # Setting blockchain configuration. (Usually this would be done during the creation of the genesis block.)
 blockchain.Blockchain.makeGenesis(block.Block, transaction.Transaction)
 
 
 class TestUtils(TestCase):
     def test_verify_signature(self):
-        sig = utils.sign(kp.private, b"hello")
-        self.assertTrue(utils.verifySignature(kp.public, b"hello", sig))
-        self.assertFalse(utils.verifySignature(kp.public, b"goodbye", sig))
+        sig = utils.sign(kp["private"], b"hello")
+        self.assertTrue(utils.verifySignature(kp["public"], b"hello", sig))
+        self.assertFalse(utils.verifySignature(kp["public"], b"goodbye", sig))
+        self.assertFalse(utils.verifySignature(b"not a key", b"hello", sig))
+
+    def test_lru_cache(self):
+        cache = utils.LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)  # evicts "b", the least recently used entry
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.getOrCompute("c", lambda k: 0), 3)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_lazy_heap(self):
+        live = {"a", "b", "c"}
+        heap = utils.LazyHeap(live)
+        for key, item in [(2, "a"), (1, "b"), (1, "c")]:
+            heap.push(key, item)
+        live.discard("b")
+        self.assertEqual(heap.peek(), "c")
+        self.assertEqual(heap.pop(), "c")
+        self.assertEqual(heap.pop(), "a")
+        self.assertIsNone(heap.pop())
+
+        for i in range(40):
+            heap.push(i, "gone")
+        heap.compact()
+        self.assertEqual(len(heap), 0)
+
+    def test_key_cache(self):
+        utils.keyCache.clear()
+        first = utils.importKey(kp["public"])
+        self.assertIs(utils.importKey(kp["public"]), first)
+        self.assertEqual((utils.keyCache.hits, utils.keyCache.misses), (1, 1))
 
 
 class TestTransaction(TestCase):
     def test_total_output(self):
         outputs = [{"amount": 20, "address": "ffff"},
                    {"amount": 40, "address": "face"}]
-        t = transaction.Transaction(addr, kp.public, outputs, 1, 1)
-        t.sign(kp.private)
-        self.assertEqual(t.totalOutput(), 61)
+        t = transaction.Transaction(addr, 0, kp["public"], outputs=outputs, fee=1)
+        t.sign(kp["private"])
+        self.assertEqual(t.total_output(), 61)
+
+    def test_id_fields_are_frozen(self):
+        outputs = [{"amount": 20, "address": "ffff"}]
+        t = transaction.Transaction(addr, 0, kp["public"], outputs=outputs, fee=1)
+        tx_id = t.id
+        outputs[0]["amount"] = 40
+        self.assertEqual(t.id, tx_id)
+        with self.assertRaises(AttributeError):
+            t.fee = 2
+        with self.assertRaises(TypeError):
+            t.outputs[0]["amount"] = 40
+        self.assertEqual(t, transaction.Transaction(addr, 0, kp["public"], outputs=[{"amount": 20, "address": "ffff"}],
+                                                    fee=1))
+
+    def test_signature_verified_once(self):
+        t = transaction.Transaction(addr, 7, kp["public"], sig=b"sig", outputs=[{"amount": 20, "address": "ffff"}])
+        with mock.patch.object(transaction, "addressMatchesKey", return_value=True), \
+                mock.patch.object(transaction, "verifySignature", return_value=True) as verify:
+            self.assertTrue(t.valid_signature())
+            self.assertTrue(t.valid_signature())
+        self.assertEqual(verify.call_count, 1)
+
+    def test_verify_signatures_batch(self):
+        txs = [transaction.Transaction(addr, n, kp["public"], sig=b"sig") for n in range(3)]
+        with mock.patch.object(transaction, "addressMatchesKey", return_value=True), \
+                mock.patch.object(transaction, "verifySignature", return_value=True) as verify:
+            self.assertTrue(transaction.verify_signatures(txs))
+            self.assertTrue(all(tx.valid_signature() for tx in txs))
+            self.assertFalse(transaction.verify_signatures(txs + [transaction.Transaction(addr, 3, kp["public"])]))
+        self.assertEqual(verify.call_count, 3)
 
 
 class TestBlock(TestCase):
@@ -40,21 +123,25 @@ class TestBlock(TestCase):
         prev_block.balances = {addr: 500, "ffff": 100, "face": 99}
 
         outputs = [{"amount": 20, "address": "ffff"}, {"amount": 40, "address": "face"}]
-        t = transaction.Transaction(addr, kp.public, outputs, 1, 0)
+        t = transaction.Transaction(addr, 0, kp["public"], outputs=outputs, fee=1)
 
         b = block.Block(addr, prev_block)
         self.assertFalse(b.addTransaction(t))  # should fail if a transaction is not signed
 
-        tx = transaction.Transaction(addr, kp.public, [{"amount": 20000000000000, "address": "ffff"}], 1, 1)
-        tx.sign(kp.private)
+        tx = transaction.Transaction(addr, 0, kp["public"], outputs=[{"amount": 20000000000000, "address": "ffff"}], fee=1)
+        tx.sign(kp["private"])
         self.assertFalse(b.addTransaction(tx))  # should fail if the 'from' account does not have enough gold.
 
-        t.sign(kp.private)
+        t.sign(kp["private"])
         b.addTransaction(t)
         self.assertEqual(b.balances[addr], 500 - 61)  # Extra 1 for transaction fee.
         self.assertEqual(b.balances["ffff"], 100 + 20)
         self.assertEqual(b.balances["face"], 99 + 40)
 
+        proof = b.inclusionProof(t.id)
+        self.assertTrue(block.Block.verifyInclusion(t.id, proof, b.header.txRoot))
+        self.assertIsNone(b.inclusionProof(tx.id))
+
         b2 = block.Block(addr, b)
         b2.addTransaction(t)  # should ignore any transactions that were already received in a previous block.
         self.assertFalse(b2.transactions)
@@ -64,10 +151,10 @@ class TestBlock(TestCase):
         prev_block.balances = {addr: 500, "ffff": 100, "face": 99}
 
         outputs = [{"amount": 20, "address": "ffff"}, {"amount": 40, "address": "face"}]
-        t = transaction.Transaction(addr, kp.public, outputs, 1, 0)
+        t = transaction.Transaction(addr, 0, kp["public"], outputs=outputs, fee=1)
 
         b = block.Block(addr, prev_block)
-        t.sign(kp.private)
+        t.sign(kp["private"])
         b.addTransaction(t)
 
         # Wiping out balances and then rerunning the block
@@ -77,3 +164,1026 @@ class TestBlock(TestCase):
         # Verifying prevBlock's balances are unchanged.
         self.assertEqual(prev_block.balances[addr], 500)
         self.assertEqual(prev_block.balances["ffff"], 100)
+
+    def test_header_hash_ignores_ledger_state(self):
+        b = block.Block(addr)
+        b.balances = {addr: 500}
+        h = b.hashVal()
+        b.balances = {str(i): i for i in range(1000)}
+        self.assertEqual(b.hashVal(), h)
+        self.assertEqual(len(b.header.serialize()), block.HEADER_SIZE)
+
+        b.proof += 1
+        self.assertNotEqual(b.hashVal(), h)
+
+
+class TestMerkleTree(TestCase):
+    def test_inclusion_proofs(self):
+        leaves = [sha256(bytes([i])).digest() for i in range(11)]
+        tree = merkle.MerkleTree()
+        roots = set()
+        for leaf in leaves:
+            tree.append(leaf)
+            roots.add(tree.root())
+        self.assertEqual(len(roots), len(leaves))
+        self.assertEqual(merkle.MerkleTree(leaves).root(), tree.root())
+
+        for leaf in leaves:
+            self.assertTrue(merkle.verifyProof(leaf, tree.proof(leaf), tree.root()))
+        self.assertFalse(merkle.verifyProof(leaves[0], tree.proof(leaves[1]), tree.root()))
+        self.assertIsNone(tree.proof(b"missing"))
+
+
+class TestBlockIndex(TestCase):
+    def test_ancestor_queries(self):
+        index = block_index.BlockIndex()
+        index.add("g", None, 0)
+        for h in range(1, 100):
+            index.add(f"a{h}", f"a{h - 1}" if h > 1 else "g", h)
+        for h in range(41, 60):
+            index.add(f"b{h}", f"b{h - 1}" if h > 41 else "a40", h)
+
+        self.assertEqual(index.ancestorAtHeight("a99", 17), "a17")
+        self.assertEqual(index.ancestorAtHeight("b59", 0), "g")
+        self.assertIsNone(index.ancestorAtHeight("a17", 18))
+        self.assertEqual(index.commonAncestor("a99", "b59"), "a40")
+        self.assertEqual(index.commonAncestor("a30", "b59"), "a30")
+        self.assertTrue(index.isAncestor("a40", "b45"))
+        self.assertFalse(index.isAncestor("a41", "b45"))
+        with self.assertRaises(KeyError):
+            index.add("c8", "c7", 8)
+        with self.assertRaises(ValueError):
+            index.add("c50", "a1", 50)
+
+
+class TestBlockStore(TestCase):
+    def test_store_and_read_back(self):
+        store = block_store.SqliteBlockStore(cacheSize=1)
+        genesis = block.Block()
+        b = block.Block(addr, genesis)
+        tx = transaction.Transaction(addr, 0, kp["public"], sig=b"sig", outputs=[{"amount": 20, "address": "ffff"}])
+        b.appendTransaction(tx)
+        store[genesis.id] = genesis
+        store[b.id] = b
+
+        self.assertEqual(len(store), 2)
+
+        store.cache.clear()
+        stored = store[b.id]
+        self.assertIsNot(stored, b)
+        self.assertEqual(stored.id, b.id)
+        self.assertEqual(stored.transactions[tx.id].sig, b"sig")
+        self.assertNotIn("missing", store)
+
+
+class TestCodec(TestCase):
+    def test_block_round_trip(self):
+        genesis = block.Block()
+        b = block.Block(addr, genesis)
+        b.proof = 77
+        for nonce in range(3):
+            tx = transaction.Transaction(addr, nonce, kp["public"], sig=bytes(128), fee=1,
+                                         outputs=[{"amount": 20, "address": "ffff"}, {"amount": 5, "address": addr}],
+                                         data={"memo": "rent"} if nonce == 1 else None)
+            b.appendTransaction(tx)
+
+        for original in (genesis, b):
+            encoded = codec.encodeBlock(original)
+            decoded = codec.decodeBlock(memoryview(encoded))
+            self.assertEqual(decoded.id, original.id)
+            self.assertEqual(decoded.serialize(), block.Block.deserialize(json.loads(original.serialize())).serialize())
+            self.assertLess(len(encoded), len(original.serialize()))
+
+        header = codec.decodeHeader(codec.encodeHeader(b.header))
+        self.assertEqual(header.hashVal(), b.id)
+
+        tx = b.transactions[next(iter(b.transactions))]
+        self.assertEqual(codec.decodeTransaction(codec.encodeTransaction(tx)).id, tx.id)
+        with self.assertRaises(codec.DecodeError):
+            codec.decodeTransaction(codec.encodeBlock(b))
+
+    def test_lazy_block_view(self):
+        b = block.Block(addr, block.Block())
+        tx = transaction.Transaction(addr, 0, kp["public"], sig=bytes(128), outputs=[{"amount": 20, "address": "ffff"}])
+        b.appendTransaction(tx)
+        encoded = bytearray(codec.encodeBlock(b))
+
+        view = codec.BlockView(encoded)
+        self.assertEqual((view.id, view.prevBlockHash, view.chainLength), (b.id, b.prevBlockHash, b.chainLength))
+        self.assertIsNone(view._block)
+        self.assertEqual(list(view.transactions), [tx.id])
+
+        # Corrupting a transaction is only noticed once the body is decoded.
+        encoded[-12] ^= 0xff  # inside the output amount
+        view = codec.BlockView(encoded)
+        self.assertEqual(view.id, b.id)
+        with self.assertRaises(codec.DecodeError):
+            view.materialize()
+
+    def test_compact_block(self):
+        b = block.Block(addr, block.Block())
+        txs = [transaction.Transaction(addr, n, kp["public"], sig=bytes(128), outputs=[{"amount": 1, "address": "ffff"}])
+               for n in range(4)]
+        for tx in txs:
+            b.appendTransaction(tx)
+
+        encoded = codec.encodeCompactBlock(b)
+        self.assertEqual(len(encoded), len(codec.encodeBlock(block.Block(addr, block.Block()))) + 4 * codec.SHORT_ID_SIZE)
+        compact = codec.CompactBlock(encoded)
+        self.assertEqual(compact.id, b.id)
+        found, missing = compact.match(txs[::2])
+        self.assertEqual(missing, [1, 3])
+
+        found[1], found[3] = txs[3], txs[1]
+        with self.assertRaises(codec.DecodeError):
+            compact.toBlock(found)
+        self.assertEqual(compact.toBlock(txs).id, b.id)
+
+
+class TestMempool(TestCase):
+    @staticmethod
+    def make_tx(sender, nonce, fee):
+        return transaction.Transaction(sender, nonce, kp["public"], outputs=[{"amount": 1, "address": "ffff"}], fee=fee)
+
+    def test_select_by_fee_and_nonce(self):
+        pool = mempool.Mempool()
+        for tx in [self.make_tx("a", 1, 5), self.make_tx("a", 0, 1), self.make_tx("b", 0, 3),
+                   self.make_tx("c", 1, 9)]:
+            pool.add(tx)
+        selected = [(tx.from_address, tx.nonce) for tx in pool.select(lambda sender: 0)]
+        # c/1 is held until c/0 arrives; a/1 only follows a/0.
+        self.assertEqual(selected, [("b", 0), ("a", 0), ("a", 1)])
+
+        pool.add(self.make_tx("c", 0, 1))
+        self.assertIn(("c", 1), [(tx.from_address, tx.nonce) for tx in pool.select(lambda sender: 0)])
+
+    def test_evict_and_confirm(self):
+        pool = mempool.Mempool(maxSize=2)
+        cheap = self.make_tx("a", 0, 1)
+        pool.add(cheap)
+        pool.add(self.make_tx("b", 0, 5))
+        pool.add(self.make_tx("c", 0, 3))
+        self.assertNotIn(cheap, pool)
+        self.assertEqual(len(pool), 2)
+
+        pool.add(self.make_tx("b", 1, 5))
+        pool.removeConfirmed([self.make_tx("b", 1, 5)])
+        self.assertNotIn("b", pool.bySender)
+
+        # A different transaction with the same nonce was confirmed instead.
+        pool.removeConfirmed([self.make_tx("c", 0, 4)])
+        self.assertEqual(len(pool), 0)
+
+
+class TestMiner(TestCase):
+    def test_sync_transactions_on_reorg(self):
+        txs = [transaction.Transaction(addr, n, kp["public"], outputs=[{"amount": 1, "address": "ffff"}], fee=1)
+               for n in range(6)]
+        m = miner.Miner(name="Minnie", keyPair=kp)
+
+        def make_block(prev, *block_txs):
+            b = block.Block(addr, prev)
+            for tx in block_txs:
+                b.appendTransaction(tx)
+            m.addBlock(b)
+            return b
+
+        genesis = make_block(None)
+        old_tip = make_block(genesis, txs[1])
+        new_tip = make_block(make_block(genesis, txs[2]), txs[3])
+        m.currentBlock = block.Block(m.address, old_tip)
+        m.currentBlock.appendTransaction(txs[4])
+        m.transactions.add(txs[2])
+        m.transactions.add(txs[5])
+
+        confirmed, orphaned, touched = m.syncTransactions(new_tip, old_tip)
+        self.assertEqual(confirmed.keys(), {txs[2].id, txs[3].id})
+        self.assertEqual(orphaned, {txs[1]})
+        self.assertEqual(touched, {addr, "ffff"})
+        self.assertNotIn(txs[2], m.transactions)
+        self.assertIn(txs[5], m.transactions)
+
+    @mock.patch.object(transaction, "verifySignature", return_value=True)
+    @mock.patch.object(transaction, "addressMatchesKey", return_value=True)
+    def test_template_follows_reorg(self, *_):
+        a, b, c = (f"{i:064x}" for i in range(10, 13))
+        genesis = block.Block(f"{1:064x}")
+        genesis.balances.update({a: 100, b: 100})
+        m = miner.Miner(name="Minnie", startingBlock=genesis, keyPair={'public': 'Minnie'})
+        m.startNewSearch()
+
+        def make_tx(sender, nonce, amount):
+            return transaction.Transaction(sender, nonce, kp["public"], sig=b"sig",
+                                           outputs=[{"amount": amount, "address": c}], fee=1)
+
+        a0, a1, b0 = make_tx(a, 0, 10), make_tx(a, 1, 10), make_tx(b, 0, 5)
+        for tx in (a0, a1, b0):
+            m.addTransaction(tx.toJSON())
+        self.assertEqual(list(m.currentBlock.transactions), [a0.id, a1.id, b0.id])
+
+        def make_block(prev, *txs):
+            nb = next_block(prev, f"{2:064x}")
+            for tx in txs:
+                self.assertTrue(nb.addTransaction(tx))
+            return nb
+
+        # A competing block confirms a0; a1 and b0 stay without being replayed.
+        x = make_block(genesis, a0)
+        with mock.patch.object(block.Block, "addTransaction") as add:
+            m.receiveBlock(x)
+        add.assert_not_called()
+        template = m.currentBlock
+        self.assertEqual(template.prevBlockHash, x.id)
+        self.assertEqual(list(template.transactions), [a1.id, b0.id])
+        self.assertEqual(template.txRoot(), merkle.MerkleTree(bytes.fromhex(i) for i in template.transactions).root())
+        self.assertEqual(template.balanceOf(a), 78)
+        self.assertEqual(template.balanceOf(c), 15 + 10)
+        self.assertEqual(template.balanceOf(f"{2:064x}"), block.COINBASE_AMT_ALLOWED + 1)
+
+        # A longer fork confirms b0 instead, orphaning a0 and so a1.
+        y = make_block(genesis, b0)
+        m.receiveBlock(y)
+        m.receiveBlock(make_block(y))
+        self.assertIs(m.currentBlock, template)
+        self.assertEqual(list(template.transactions), [a0.id, a1.id])
+        self.assertEqual(template.balanceOf(a), 78)
+        self.assertEqual(template.nextNonce[a], 2)
+        self.assertNotIn(b, template.nextNonce.changes)
+        self.assertEqual(len(m.transactions), 0)
+
+
+class TestOrphanPool(TestCase):
+    def setUp(self):
+        self.chain = [block.Block(addr)]
+        for _ in range(6):
+            self.chain.append(next_block(self.chain[-1]))
+
+    def test_index_by_parent(self):
+        pool = orphan_pool.OrphanPool()
+        sibling = block.Block(f"{1:064x}", self.chain[1])
+        for b in (self.chain[2], sibling, self.chain[3]):
+            self.assertTrue(pool.add(b))
+        self.assertFalse(pool.add(self.chain[2]))
+        self.assertTrue(pool.isWaitingFor(self.chain[1].id))
+        self.assertEqual({b.id for b in pool.popChildren(self.chain[1].id)}, {self.chain[2].id, sibling.id})
+        self.assertFalse(pool.isWaitingFor(self.chain[1].id))
+        self.assertEqual(len(pool), 1)
+
+    def test_eviction(self):
+        oldest = orphan_pool.OrphanPool(maxSize=2)
+        lowest = orphan_pool.OrphanPool(maxSize=2, policy=orphan_pool.EVICT_LOWEST)
+        for b in (self.chain[3], self.chain[2], self.chain[4]):
+            oldest.add(b)
+            lowest.add(b)
+        self.assertNotIn(self.chain[3].id, oldest)
+        self.assertIn(self.chain[2].id, oldest)
+        self.assertNotIn(self.chain[2].id, lowest)
+        self.assertIn(self.chain[3].id, lowest)
+        self.assertFalse(lowest.add(self.chain[1]))
+
+    def test_expiry(self):
+        now = [0]
+        pool = orphan_pool.OrphanPool(maxAge=10, clock=lambda: now[0])
+        pool.add(self.chain[2])
+        now[0] = 5
+        pool.add(self.chain[3])
+        now[0] = 12
+        pool.expire()
+        self.assertEqual([b.id for b in pool.popChildren(self.chain[2].id)], [self.chain[3].id])
+        self.assertEqual(len(pool), 0)
+
+    def test_long_orphan_chain_connects_without_recursion(self):
+        chain = [block.Block(addr)]
+        chain[0].timestamp -= 3000 * blockchain.TARGET_BLOCK_TIME  # so that no block is in the future
+        for _ in range(3000):
+            chain.append(next_block(chain[-1]))
+        c = client.Client(name="Late", net=mock.Mock(), startingBlock=chain[0], keyPair={'public': 'Late'})
+        c.pendingBlocks = orphan_pool.OrphanPool(maxSize=len(chain))
+        for b in chain[2:]:
+            c.receiveBlock(b)
+        self.assertEqual(c.net.recognizes.call_count, 1)
+        c.receiveBlock(chain[1])
+        self.assertEqual(c.lastBlock.id, chain[-1].id)
+        self.assertEqual(len(c.pendingBlocks), 0)
+
+
+class TestDifficulty(TestCase):
+    def build_chain(self, block_time, length):
+        # Block timestamps follow a virtual clock advanced by block_time ms per block.
+        now = [1000.0]
+        utils.setClock(lambda: now[0])
+        self.addCleanup(utils.setClock)
+        d = difficulty.Difficulty(interval=10, blockTime=1000)
+        chain = [block.Block(addr, target=2 ** 240)]
+        blocks = {chain[0].id: chain[0]}
+        index = block_index.BlockIndex()
+        index.add(chain[0].id, None, 0)
+        for _ in range(length):
+            now[0] += block_time / 1000
+            b = block.Block(addr, chain[-1], target=d.nextTarget(chain[-1].id, blocks, index))
+            blocks[b.id] = b
+            index.add(b.id, b.prevBlockHash, b.chainLength)
+            chain.append(b)
+        return d, chain, blocks, index
+
+    def test_fast_blocks_raise_difficulty(self):
+        d, chain, blocks, index = self.build_chain(500, 10)
+        self.assertTrue(all(b.target == 2 ** 240 for b in chain[:10]))
+        self.assertEqual(chain[10].target, 2 ** 239)
+
+        easy = block.Block(addr, chain[9], target=2 ** 240)
+        self.assertFalse(d.isValidTarget(easy, blocks, index))
+        self.assertTrue(d.isValidTarget(chain[10], blocks, index))
+
+    def test_harder_block_does_not_raise_required_target(self):
+        d, chain, blocks, index = self.build_chain(1000, 5)
+        hard = block.Block(addr, chain[-1], target=2 ** 230)
+        blocks[hard.id] = hard
+        index.add(hard.id, hard.prevBlockHash, hard.chainLength)
+        self.assertEqual(d.requiredTarget(hard.id, blocks, index), 2 ** 240)
+        self.assertEqual(d.nextTarget(hard.id, blocks, index), 2 ** 240)
+
+    def test_retarget_is_clamped(self):
+        _, chain, _, _ = self.build_chain(100000, 20)
+        self.assertEqual(chain[10].target, 2 ** 242)
+        self.assertEqual(chain[20].target, 2 ** 244)
+
+
+class TestMinerTransactions(TestCase):
+    def test_posted_transaction_is_mined(self):
+        genesis = block.Block(f"{1:064x}")
+        genesis.balances[addr] = 100
+        m = miner.Miner(name="Minnie", startingBlock=genesis, keyPair={'public': 'Minnie'})
+        tx = transaction.Transaction(addr, 0, kp["public"], outputs=[{"amount": 30, "address": "ffff"}], fee=1)
+        tx.sign(kp["private"])
+        forged = transaction.Transaction(addr, 1, kp["public"], sig=b"bogus", outputs=[{"amount": 1, "address": "ffff"}])
+
+        m.addTransaction(tx.toJSON())
+        m.addTransaction(forged.toJSON())
+        self.assertEqual(len(m.transactions), 1)
+
+        m.startNewSearch()
+        self.assertEqual(list(m.currentBlock.transactions), [tx.id])
+        self.assertEqual(m.currentBlock.balanceOf(addr), 69)
+        self.assertEqual(m.currentBlock.balanceOf("ffff"), 30)
+        self.assertEqual(len(m.transactions), 0)
+
+    def test_shutdown_releases_workers(self):
+        genesis = block.Block(f"{1:064x}")
+        m = miner.Miner(name="Minnie", net=mock.Mock(), startingBlock=genesis, keyPair={'public': 'Minnie'},
+                        miningWorkers=2)
+        m.startNewSearch()
+        m.findProof(oneAndDone=True)
+        self.assertEqual(m.lastBlock.prevBlockHash, genesis.id)
+        self.assertGreater(m.hashRate, 0)
+
+        search = m.parallelSearch
+        m.shutdown()
+        self.assertIsNone(m.parallelSearch)
+        with self.assertRaises(RuntimeError):
+            search.executor.submit(int)
+
+    def test_proof_for_moved_template_is_discarded(self):
+        genesis = block.Block(f"{1:064x}")
+        genesis.timestamp -= 10 * blockchain.TARGET_BLOCK_TIME
+        m = miner.Miner(name="Minnie", net=mock.Mock(), startingBlock=genesis, keyPair={'public': 'Minnie'})
+        m.startNewSearch()
+        template = m.currentBlock
+        competing = next_block(genesis, f"{2:064x}")
+
+        def search(self, start, count):
+            # A competing block arrives while we are searching.
+            m.receiveBlock(competing)
+            return start
+
+        with mock.patch.object(mining.ProofSearch, "search", search):
+            m.findProof(oneAndDone=True)
+        self.assertIs(m.currentBlock, template)
+        self.assertEqual(template.prevBlockHash, competing.id)
+        self.assertEqual(template.proof, 0)
+        m.net.broadcast.assert_not_called()
+
+    def test_template_built_on_ledger(self):
+        genesis = block.Block(f"{1:064x}")
+        genesis.balances[addr] = 100
+        m = miner.Miner(name="Minnie", startingBlock=genesis, keyPair={'public': 'Minnie'})
+        m.startNewSearch()
+        b = next_block(genesis, f"{2:064x}")
+        tx = transaction.Transaction(addr, 0, kp["public"], outputs=[{"amount": 30, "address": "ffff"}], fee=1)
+        tx.sign(kp["private"])
+        b.addTransaction(tx)
+
+        # A decoded block carries no balances of its own.
+        m.receiveBlock(codec.encodeBlock(b))
+        self.assertEqual(m.lastBlock.id, b.id)
+        self.assertEqual(m.currentBlock.balanceOf(addr), 69)
+        self.assertEqual(m.currentBlock.balanceOf(f"{2:064x}"), block.COINBASE_AMT_ALLOWED + 1)
+        self.assertEqual(m.currentBlock.nextNonce.get(addr), 1)
+
+        c = client.Client(name="Alice", startingBlock=genesis, keyPair=kp)
+        c.receiveBlock(codec.encodeBlock(b))
+        self.assertEqual(c.confirmedBalance, 100)
+        for _ in range(blockchain.CONFIRMED_DEPTH - 1):
+            b = next_block(b, f"{2:064x}")
+            c.receiveBlock(codec.encodeBlock(b))
+            self.assertEqual(c.confirmedBalance, 100)
+        c.receiveBlock(codec.encodeBlock(next_block(b, f"{2:064x}")))
+        self.assertEqual(c.confirmedBalance, 69)
+        self.assertEqual(c.ledger.balanceOf(addr), 69)
+
+
+class TestMining(TestCase):
+    def test_search_matches_header_proof(self):
+        b = block.Block(addr)
+        b.target = block.POW_BASE_TARGET >> 8
+        header = b.header
+        search = mining.ProofSearch(header.prefix(), header.target)
+        proof = search.search(0, 100000)
+        self.assertIsNotNone(proof)
+        self.assertEqual(search.hashes, proof + 1)
+
+        b.proof = proof
+        self.assertTrue(b.hasValidProof())
+
+    def test_parallel_search_splits_range(self):
+        target = block.POW_BASE_TARGET >> 6
+        # A prefix whose first proof is not nonce 0, so both ranges are non-empty.
+        prefix = next(bytes([i]) * 8 for i in range(256) if mining.ProofSearch(bytes([i]) * 8, target).search(0, 1) is None)
+        first = mining.ProofSearch(prefix, target).search(0, 100000)
+
+        # The first worker's range ends just before the first proof.
+        parallel = mining.ParallelProofSearch(2)
+        try:
+            proof, hashes = parallel.search(prefix, target, 0, first)
+        finally:
+            parallel.shutdown()
+        self.assertEqual(proof, first)
+        self.assertLessEqual(hashes, 2 * first)
+
+    def test_parallel_search_cancelled_before_start(self):
+        parallel = mining.ParallelProofSearch(2)
+        try:
+            parallel.cancel()
+            self.assertEqual(parallel.search(b"prefix", 0, 0, 10 ** 9), (None, 0))
+            proof, hashes = parallel.search(b"prefix", 2 ** 256, 0, 10)
+            self.assertIn(proof, (0, 10))
+        finally:
+            parallel.shutdown()
+
+    def test_parallel_search_cancel(self):
+        parallel = mining.ParallelProofSearch(2)
+        result = []
+        try:
+            thread = threading.Thread(target=lambda: result.append(parallel.search(b"prefix", 0, 0, 10 ** 9)))
+            thread.start()
+            time.sleep(0.2)
+            parallel.cancel()
+            thread.join(10)
+        finally:
+            parallel.shutdown()
+        self.assertFalse(thread.is_alive())
+        proof, hashes = result[0]
+        self.assertIsNone(proof)
+        self.assertLess(hashes, 2 * 10 ** 9)
+
+
+class TestLedgerState(TestCase):
+    def test_child_shares_parent_state(self):
+        parent = ledger.LedgerState({addr: 500, "ffff": 100})
+        child = ledger.LedgerState(parent)
+        child["ffff"] = 120
+        child["face"] = 40
+
+        self.assertEqual(child[addr], 500)
+        self.assertEqual(child["ffff"], 120)
+        self.assertEqual(parent["ffff"], 100)
+        self.assertNotIn("face", parent)
+        self.assertEqual(child.changes, {"ffff": 120, "face": 40})
+        self.assertEqual(dict(child), {addr: 500, "ffff": 120, "face": 40})
+
+    def test_flattens_deep_chains(self):
+        state = ledger.LedgerState({addr: 0})
+        for i in range(ledger.FLATTEN_DEPTH * 2):
+            state = ledger.LedgerState(state)
+            state[addr] = i
+        self.assertLessEqual(state.depth, ledger.FLATTEN_DEPTH)
+        self.assertEqual(state[addr], ledger.FLATTEN_DEPTH * 2 - 1)
+
+
+class TestLedger(TestCase):
+    def test_reorg_with_undo_logs(self):
+        genesis = block.Block()
+        genesis.balances = {addr: 500, "ffff": 100}
+        blocks = {genesis.id: genesis}
+        index = block_index.BlockIndex()
+        index.add(genesis.id, None, 0)
+
+        def make_block(prev, *outputs):
+            b = block.Block("face", prev)
+            for nonce, output in enumerate(outputs, prev.nextNonce.get(addr, 0)):
+                tx = transaction.Transaction(addr, nonce, kp["public"], outputs=[output], fee=1)
+                b.appendTransaction(tx)
+                b.nextNonce[addr] = nonce + 1
+            blocks[b.id] = b
+            index.add(b.id, b.prevBlockHash, b.chainLength)
+            return b
+
+        a1 = make_block(genesis, {"amount": 20, "address": "ffff"})
+        a2 = make_block(a1, {"amount": 30, "address": "beef"})
+        b1 = make_block(genesis, {"amount": 5, "address": "ffff"}, {"amount": 5, "address": "ffff"})
+
+        state = ledger.Ledger(genesis)
+        self.assertTrue(state.apply(a1, genesis))
+        self.assertTrue(state.apply(a2, a1))
+        self.assertEqual(state.balanceOf("beef"), 30)
+        self.assertEqual(state.balanceOf("face"), 1 + block.COINBASE_AMT_ALLOWED)
+
+        self.assertTrue(state.reorg(b1.id, blocks, index))
+        self.assertEqual(state.tipId, b1.id)
+        self.assertEqual(state.balances, {addr: 500 - 12, "ffff": 110})
+        self.assertEqual(state.nextNonce, {addr: 2})
+        self.assertEqual(state.undoLogs.keys(), {b1.id})
+
+        # A block that does not apply leaves the ledger untouched.
+        bad = make_block(b1, {"amount": 1000, "address": "ffff"})
+        self.assertFalse(state.apply(bad, b1))
+        self.assertEqual(state.balances, {addr: 500 - 12, "ffff": 110})
+
+        # Only the most recent undo logs are kept.
+        state = ledger.Ledger(genesis, maxUndo=1)
+        self.assertTrue(state.apply(a1, genesis))
+        self.assertTrue(state.apply(a2, a1))
+        self.assertEqual(state.undoLogs.keys(), {a2.id})
+        self.assertFalse(state.canReorg(b1.id, index))
+        with self.assertRaises(ValueError):
+            state.reorg(b1.id, blocks, index)
+        self.assertEqual(state.tipId, a2.id)
+
+
+class RecordingClient:
+    def __init__(self, address, log):
+        self.address = address
+        self.log = log
+
+    def emit(self, msg, o):
+        self.log.append((self.address, msg, o))
+
+
+class TestFakeNet(TestCase):
+    def simulate(self, seed):
+        log = []
+        scheduler = fake_net.MessageScheduler(virtual_time=True)
+        net = fake_net.FakeNet(chance_message_fails=0.2, message_delay=10, scheduler=scheduler, seed=seed)
+        net.register(*[RecordingClient(i, log) for i in range(10)])
+        for k in range(5):
+            net.broadcast("PING", {"k": k})
+        self.assertEqual(log, [])  # nothing is delivered until the scheduler runs
+        scheduler.run()
+        return log
+
+    def test_scheduler_is_deterministic(self):
+        log = self.simulate(seed=42)
+        self.assertTrue(0 < len(log) < 50)
+        self.assertEqual(log, self.simulate(seed=42))
+
+    def test_failing_handler_does_not_stop_delivery(self):
+        received = threading.Event()
+        net = fake_net.FakeNet(scheduler=fake_net.MessageScheduler())
+        failing, healthy = RecordingClient("a", []), RecordingClient("b", [])
+        failing.emit = mock.Mock(side_effect=RuntimeError("boom"))
+        healthy.emit = lambda msg, o: received.set()
+        net.register(failing, healthy)
+
+        net.send_message("nobody", "PING", {})  # unknown addresses are dropped
+        self.assertEqual(net.scheduler.queue, [])
+        with mock.patch.object(fake_net.traceback, "print_exc") as print_exc:
+            net.send_message("a", "PING", {})
+            net.send_message("b", "PING", {})
+            self.assertTrue(received.wait(5))
+        print_exc.assert_called_once()
+
+    def test_broadcast_payload_isolation(self):
+        for share in (False, True):
+            log = []
+            scheduler = fake_net.MessageScheduler(virtual_time=True)
+            net = fake_net.FakeNet(scheduler=scheduler, share_payloads=share)
+            net.register(RecordingClient("a", log), RecordingClient("b", log))
+            payload = {"outputs": [{"amount": 1}]}
+            net.broadcast("PING", payload)
+            payload["outputs"].append({"amount": 2})  # changes after sending are not seen
+            scheduler.run()
+
+            (_, _, first), (_, _, second) = log
+            self.assertEqual(len(first["outputs"]), 1)
+            if share:
+                self.assertIs(first, second)
+                with self.assertRaises(TypeError):
+                    first["outputs"] = []
+            else:
+                self.assertIsNot(first, second)
+
+    def test_gossip_reaches_every_node_once(self):
+        log = []
+        scheduler = fake_net.MessageScheduler(virtual_time=True)
+        net = fake_net.FakeNet(message_delay=10, scheduler=scheduler, seed=3, fanout=3)
+        net.register(*[RecordingClient(i, log) for i in range(50)])
+        message_id = net.broadcast("PING", {"k": 1}, sender=0)
+        scheduler.run()
+
+        self.assertEqual(sorted(address for address, _, _ in log), list(range(1, 50)))
+        stats = net.stats[message_id].summary()
+        self.assertEqual(stats['reached'], 49)
+        self.assertEqual(stats['messages'], 49 + stats['duplicates'])
+        self.assertLess(stats['messages'], 49 * 49)
+        self.assertLessEqual(stats['p50'], stats['p90'])
+        self.assertLessEqual(stats['p90'], stats['p100'])
+
+    def test_gossip_keeps_recent_stats(self):
+        log = []
+        scheduler = fake_net.MessageScheduler(virtual_time=True)
+        net = fake_net.FakeNet(scheduler=scheduler, seed=3, fanout=2, stats_capacity=2)
+        net.register(*[RecordingClient(i, log) for i in range(5)])
+        ids = [net.broadcast("PING", {"k": k}, sender=0) for k in range(3)]
+        scheduler.run()
+
+        self.assertEqual(list(net.stats), ids[1:])
+        self.assertEqual(len(log), 3 * 4)  # messages whose stats were dropped are still delivered
+
+    def test_gossip_needs_sender(self):
+        net = fake_net.FakeNet(fanout=2)
+        net.register(*[RecordingClient(i, []) for i in range(3)])
+        with self.assertRaises(ValueError):
+            net.broadcast("PING", {})
+
+
+class TestRotatingBloomFilter(TestCase):
+    def test_remembers_recent_keys(self):
+        seen = fake_net.RotatingBloomFilter(capacity=100)
+        for i in range(250):
+            seen.add(str(i).encode())
+        self.assertTrue(all(str(i).encode() in seen for i in range(200, 250)))
+        self.assertLess(sum(str(i).encode() in seen for i in range(1000, 2000)), 20)
+
+
+class TestClientSync(TestCase):
+    def make_client(self, name, net, genesis):
+        c = client.Client(name=name, net=net, startingBlock=genesis, keyPair={'public': name, 'private': None})
+        net.register(c)
+        return c
+
+    def setUp(self):
+        self.chain = [block.Block(addr)]
+        # Far enough back that chains built on it stay in the past.
+        self.chain[0].timestamp -= 100 * blockchain.TARGET_BLOCK_TIME
+        for _ in range(10):
+            self.chain.append(next_block(self.chain[-1]))
+
+    def test_miners_converge(self):
+        scheduler = fake_net.MessageScheduler(virtual_time=True)
+        net = fake_net.FakeNet(message_delay=5, scheduler=scheduler, seed=1)
+        genesis = block.Block(addr, target=2 ** 254)
+        miners = [miner.Miner(name=f"M{i}", net=net, startingBlock=genesis, keyPair={'public': f"M{i}"},
+                              miningRounds=1) for i in range(3)]
+        net.register(*miners)
+        for m in miners:
+            m.startNewSearch()
+        for _ in range(20):
+            for m in miners:
+                m.findProof(oneAndDone=True)
+            scheduler.run()
+        # Ties are broken by whichever block a miner saw first, so one miner
+        # carries on alone until its chain is the longest.
+        for _ in range(100):
+            if len({m.lastBlock.id for m in miners}) == 1:
+                break
+            miners[0].findProof(oneAndDone=True)
+            scheduler.run()
+        self.assertEqual(len({m.lastBlock.id for m in miners}), 1)
+        self.assertGreater(miners[0].lastBlock.chainLength, 1)
+
+    @mock.patch.object(blockchain, 'HEADERS_BATCH_SIZE', 4)
+    @mock.patch.object(blockchain, 'BODIES_BATCH_SIZE', 3)
+    def test_headers_first_sync(self):
+        scheduler = fake_net.MessageScheduler(virtual_time=True)
+        net = fake_net.FakeNet(message_delay=5, scheduler=scheduler, seed=1)
+        peers = [self.make_client(f"Peer{i}", net, self.chain[0]) for i in range(2)]
+        for peer in peers:
+            for b in self.chain[1:]:
+                peer.receiveBlock(b)
+        late = self.make_client("Late", net, self.chain[0])
+        late.receiveBlock(self.chain[1])
+
+        late.startSync([peer.address for peer in peers])
+        scheduler.run()
+        self.assertEqual(late.lastBlock.id, self.chain[-1].id)
+        self.assertEqual(late.syncPeers, [])
+
+    @mock.patch.object(blockchain, 'MAX_BLOCKS_PER_MESSAGE', 4)
+    def test_missing_blocks_fetched_in_ranges(self):
+        scheduler = fake_net.MessageScheduler(virtual_time=True)
+        net = fake_net.FakeNet(scheduler=scheduler)
+        peer = self.make_client("Peer", net, self.chain[0])
+        late = self.make_client("Late", net, self.chain[0])
+        chain = self.chain[:1]
+        for _ in range(10):
+            chain.append(next_block(chain[-1], peer.address))
+            peer.receiveBlock(chain[-1])
+
+        late.receiveBlock(chain[-1])
+        self.assertEqual(scheduler.run(), 6)
+        self.assertEqual(late.lastBlock.id, chain[-1].id)
+        self.assertEqual(len(late.pendingBlocks), 0)
+
+    def test_compact_block_relay(self):
+        scheduler = fake_net.MessageScheduler(virtual_time=True)
+        net = fake_net.FakeNet(scheduler=scheduler)
+        peer = self.make_client("Peer", net, self.chain[0])
+        late = self.make_client("Late", net, self.chain[0])
+        b = block.Block(peer.address, self.chain[0])
+        txs = [transaction.Transaction(addr, n, kp["public"], outputs=[{"amount": 1, "address": "ffff"}])
+               for n in range(5)]
+        for tx in txs:
+            tx.sign(kp["private"])
+            b.appendTransaction(tx)
+        peer.receiveBlock(b)
+        for tx in txs[:3]:
+            late.pendingReceivedTransactions[tx.id] = tx
+
+        net.send_message(late.address, blockchain.COMPACT_BLOCK, codec.encodeCompactBlock(b))
+        self.assertEqual(scheduler.run(), 3)
+        self.assertEqual(late.lastBlock.id, b.id)
+        self.assertEqual(late.compactBlocks, {})
+
+    def test_malformed_compact_block_ignored(self):
+        c = client.Client(name="Late", net=mock.Mock(), startingBlock=self.chain[0], keyPair={'public': 'Late'})
+        b = next_block(self.chain[0])
+        tx = transaction.Transaction(addr, 0, kp["public"], outputs=[{"amount": 1, "address": "ffff"}])
+        b.appendTransaction(tx)
+        compact = codec.encodeCompactBlock(b)
+        txn = codec.encodeBlockTxn(b.id, [tx])
+
+        self.assertIsNone(c.receiveCompactBlock(compact[:-codec.SHORT_ID_SIZE - 4]))
+        self.assertIsNone(c.receiveCompactBlock(compact))
+        self.assertIn(b.id, c.compactBlocks)
+        self.assertIsNone(c.receiveBlockTxn(txn[:-4]))
+        self.assertIn(b.id, c.compactBlocks)
+
+    def test_pending_compact_blocks_expire(self):
+        net = mock.Mock()
+        c = client.Client(name="Late", net=net, startingBlock=self.chain[0], keyPair={'public': 'Late'})
+        tx = transaction.Transaction(addr, 0, kp["public"], outputs=[{"amount": 1, "address": "ffff"}])
+        tx.sign(kp["private"])
+        announcements = []
+        for i in range(4):
+            b = next_block(self.chain[0], f"{i:064x}")
+            b.addTransaction(tx)
+            announcements.append(codec.encodeCompactBlock(b))
+
+        clock = [1000.0]
+        utils.setClock(lambda: clock[0])
+        try:
+            c.receiveCompactBlock(announcements[0])
+            c.receiveCompactBlock(announcements[0])
+            self.assertEqual(net.send_message.call_count, 1)
+            # The BLOCK_TXN answer was lost; a later announcement asks again.
+            clock[0] += blockchain.COMPACT_BLOCK_TIMEOUT + 1
+            c.receiveCompactBlock(announcements[0])
+            self.assertEqual(net.send_message.call_count, 2)
+
+            with mock.patch.object(blockchain, "MAX_PENDING_COMPACT_BLOCKS", 2):
+                for buf in announcements[1:]:
+                    c.receiveCompactBlock(buf)
+            self.assertEqual(list(c.compactBlocks), [codec.CompactBlock(buf).id for buf in announcements[2:]])
+        finally:
+            utils.setClock()
+
+    def test_shared_payload_block(self):
+        c = client.Client(name="Late", net=mock.Mock(), startingBlock=self.chain[0], keyPair={'public': 'Late'})
+        b = next_block(self.chain[0])
+        tx = transaction.Transaction(addr, 0, kp["public"], outputs=[{"amount": 1, "address": "ffff"}])
+        tx.sign(kp["private"])
+        b.addTransaction(tx)
+
+        # What a recipient gets from a FakeNet with share_payloads=True.
+        shared = fake_net.freeze(json.loads(b.serialize()))
+        self.assertEqual(c.receiveBlock(shared).id, b.id)
+        self.assertEqual(c.ledger.balanceOf("ffff"), 1)
+
+    def test_forged_signature_rejected(self):
+        c = client.Client(name="Late", net=mock.Mock(), startingBlock=self.chain[0], keyPair={'public': 'Late'})
+        forged = next_block(self.chain[0])
+        tx = transaction.Transaction(addr, 0, kp["public"], sig=b"bogus", outputs=[{"amount": 6, "address": "ffff"}])
+        forged.appendTransaction(tx)
+
+        self.assertIsNone(c.receiveBlock(codec.encodeBlock(forged)))
+        self.assertIn(forged.id, c.invalidBlocks)
+        self.assertEqual(c.ledger.tipId, self.chain[0].id)
+        self.assertEqual(c.ledger.balanceOf("ffff"), 0)
+
+    def test_truncated_block_ignored(self):
+        c = client.Client(name="Late", net=mock.Mock(), startingBlock=self.chain[0], keyPair={'public': 'Late'})
+        encoded = codec.encodeBlock(self.chain[1])
+        self.assertIsNone(c.receiveBlock(encoded[:codec.PREFIX.size + codec.BLOCK_FIELDS.size - 1]))
+        self.assertEqual(c.receiveBlock(encoded).id, self.chain[1].id)
+
+    def test_malformed_key_rejected(self):
+        c = client.Client(name="Late", net=mock.Mock(), startingBlock=self.chain[0], keyPair={'public': 'Late'})
+        forged = next_block(self.chain[0])
+        junk = b"not a key"
+        tx = transaction.Transaction(utils.calcAddress(junk), 0, junk, sig=b"bogus",
+                                     outputs=[{"amount": 6, "address": "ffff"}])
+        forged.appendTransaction(tx)
+
+        # Newest first on the wire, so the forged block is handled first.
+        c.receiveBlocks(codec.encodeBlocks([self.chain[1], forged]))
+        self.assertIn(forged.id, c.invalidBlocks)
+        self.assertEqual(c.lastBlock.id, self.chain[1].id)
+
+    def test_fork_choice_by_work(self):
+        def mine(b):
+            while not b.hasValidProof():
+                b.proof += 1
+            return b
+
+        genesis = self.chain[0]
+        c = client.Client(name="Late", net=mock.Mock(), startingBlock=genesis, keyPair={'public': 'Late'})
+        for b in self.chain[1:4]:
+            c.receiveBlock(b)
+        heavy = mine(block.Block(addr, genesis, target=2 ** 250))
+        c.receiveBlock(heavy)
+        self.assertEqual(c.lastBlock.id, heavy.id)
+        self.assertEqual(c.blockIndex.totalWork(heavy.id), block.blockWork(genesis.target) + block.blockWork(2 ** 250))
+
+        # A heavier block that cannot be applied leaves the tip where it was.
+        invalid = block.Block(addr, heavy, target=2 ** 248)
+        tx = transaction.Transaction(addr, 7, kp["public"], outputs=[{"amount": 1, "address": "ffff"}])
+        invalid.appendTransaction(tx)
+        c.receiveBlock(mine(invalid))
+        self.assertEqual(c.lastBlock.id, heavy.id)
+        self.assertIn(invalid.id, c.invalidBlocks)
+
+        # Extending the light fork past the heavy one's work switches back.
+        light = self.chain[3]
+        for _ in range(64):
+            light = next_block(light)
+            c.receiveBlock(light)
+        self.assertEqual(c.lastBlock.id, light.id)
+        self.assertEqual(c.ledger.tipId, light.id)
+
+    def test_fork_below_confirmed_blocks_ignored(self):
+        def mine(b):
+            while not b.hasValidProof():
+                b.proof += 1
+            return b
+
+        c = client.Client(name="Late", net=mock.Mock(), startingBlock=self.chain[0], keyPair={'public': 'Late'})
+        for b in self.chain[1:8]:
+            c.receiveBlock(b)
+        fork = next_block(self.chain[1], reward_addr="ffff")
+        c.receiveBlock(fork)
+        c.receiveBlock(self.chain[8])
+        self.assertEqual(len(c.ledger.undoLogs), blockchain.CONFIRMED_DEPTH)
+
+        # Heavier, but it would undo more blocks than the ledger keeps logs for.
+        heavy = block.Block(addr, fork, target=2 ** 240)
+        heavy.timestamp = fork.timestamp + blockchain.TARGET_BLOCK_TIME
+        mine(heavy)
+        c.receiveBlock(heavy)
+        self.assertIn(heavy.id, c.blockIndex)
+        self.assertEqual(c.lastBlock.id, self.chain[8].id)
+        self.assertEqual(c.ledger.tipId, self.chain[8].id)
+
+    def test_wrong_chain_length_rejected(self):
+        c = client.Client(name="Late", net=mock.Mock(), startingBlock=self.chain[0], keyPair={'public': 'Late'})
+        c.receiveBlock(self.chain[1])
+        liar = block.Block.deserialize(json.loads(self.chain[2].serialize()))
+        liar.chainLength = 50
+        self.assertIsNone(c.receiveBlock(liar))
+        self.assertNotIn(liar.id, c.blockIndex)
+        self.assertEqual(c.blockIndex.commonAncestor(self.chain[1].id, self.chain[0].id), self.chain[0].id)
+
+        # The length is not part of the header, so the honest copy still connects.
+        self.assertIsNotNone(c.receiveBlock(self.chain[2]))
+
+    def test_bad_block_does_not_abort_batch(self):
+        c = client.Client(name="Late", net=mock.Mock(), startingBlock=self.chain[0], keyPair={'public': 'Late'})
+        # The body holds a transaction the header's root does not commit to.
+        mismatched = next_block(self.chain[0], f"{3:064x}")
+        tx = transaction.Transaction(addr, 0, kp["public"], outputs=[{"amount": 1, "address": "ffff"}])
+        mismatched.transactions[tx.id] = tx
+        greedy = next_block(self.chain[0], f"{4:064x}")
+        greedy.coinbaseReward = 1000
+
+        c.receiveBlocks(codec.encodeBlocks([self.chain[2], greedy, mismatched, self.chain[1]]))
+        self.assertEqual(c.lastBlock.id, self.chain[2].id)
+        self.assertNotIn(mismatched.id, c.blockIndex)
+        self.assertNotIn(greedy.id, c.blockIndex)
+        self.assertFalse(c.invalidBlocks)
+
+    def test_blocks_served_from_store(self):
+        net = mock.Mock()
+        store = block_store.SqliteBlockStore(cacheSize=1)
+        peer = client.Client(name="Peer", net=net, startingBlock=self.chain[0], keyPair={'public': 'Peer'},
+                             blockStore=store)
+        for b in self.chain[1:5]:
+            peer.receiveBlock(b)
+        store.cache.clear()
+
+        peer.provideBlocks({'from': 'Late', 'blockId': self.chain[4].id, 'count': 3})
+        to, msg, payload = net.send_message.call_args[0]
+        self.assertEqual((to, msg), ('Late', blockchain.BLOCKS))
+        self.assertEqual([b.id for b in codec.decodeBlocks(payload)], [b.id for b in self.chain[4:1:-1]])
+
+    def test_confirm_transaction_needs_depth(self):
+        c = client.Client(name="Alice", net=mock.Mock(), startingBlock=self.chain[0], keyPair=kp)
+        tx = transaction.Transaction(addr, 0, kp["public"], outputs=[{"amount": 1, "address": "ffff"}])
+        tx.sign(kp["private"])
+        c.pendingOutgoingTransactions[tx.id] = tx
+        b = next_block(self.chain[0])
+        b.appendTransaction(tx)
+        proof = b.inclusionProof(tx.id)
+
+        # A header with a valid proof-of-work that is not on our chain.
+        self.assertFalse(c.confirmTransaction(tx.id, b.header, proof))
+        chain = [b]
+        c.receiveBlock(b)
+        for _ in range(blockchain.CONFIRMED_DEPTH):
+            self.assertFalse(c.confirmTransaction(tx.id, b.header, proof))
+            chain.append(next_block(chain[-1]))
+            c.receiveBlock(chain[-1])
+        self.assertTrue(c.confirmTransaction(tx.id, b.header, proof))
+        self.assertNotIn(tx.id, c.pendingOutgoingTransactions)
+
+        # Headers checked during a sync are enough; the bodies are not needed.
+        light = client.Client(name="Light", net=mock.Mock(), startingBlock=self.chain[0], keyPair=kp)
+        light.syncPeers = ['a']
+        light.receiveHeaders(codec.encodeHeaders([link.header for link in chain[:-1]]))
+        self.assertFalse(light.confirmTransaction(tx.id, b.header, proof))
+        light.receiveHeaders(codec.encodeHeaders([chain[-1].header]))
+        self.assertTrue(light.confirmTransaction(tx.id, b.header, proof))
+        self.assertNotIn(b.id, light.blockIndex)
+
+    def test_bookkeeping_follows_tip(self):
+        c = client.Client(name="Alice", net=mock.Mock(), startingBlock=self.chain[0], keyPair=kp)
+        for b in self.chain[1:3]:
+            c.receiveBlock(b)
+        fork = [next_block(self.chain[0])]
+        tx = transaction.Transaction(addr, 0, kp["public"], outputs=[{"amount": 1, "address": "ffff"}])
+        tx.sign(kp["private"])
+        fork[0].addTransaction(tx)
+        c.pendingReceivedTransactions[tx.id] = tx
+
+        # A block on a side fork changes nothing.
+        c.receiveBlock(fork[0])
+        self.assertEqual(c.lastBlock.id, self.chain[2].id)
+        self.assertEqual(c.nonce, 0)
+        self.assertIn(tx.id, c.pendingReceivedTransactions)
+
+        for _ in range(2):
+            fork.append(next_block(fork[-1]))
+            c.receiveBlock(fork[-1])
+        self.assertEqual(c.lastBlock.id, fork[-1].id)
+        self.assertEqual(c.nonce, 1)
+        self.assertNotIn(tx.id, c.pendingReceivedTransactions)
+
+        for b in self.chain[3:]:
+            c.receiveBlock(b)
+        self.assertEqual(c.nonce, 0)
+        self.assertIs(c.lastConfirmedBlock, self.chain[10 - blockchain.CONFIRMED_DEPTH])
+
+    def test_block_timestamps_checked(self):
+        c = client.Client(name="Late", net=mock.Mock(), startingBlock=self.chain[0], keyPair={'public': 'Late'})
+        for b in self.chain[1:]:
+            c.receiveBlock(b)
+        mtp = c.difficulty.medianTimePast(self.chain[-1].id, c.blocks, c.blockIndex)
+        self.assertEqual(mtp, self.chain[-6].timestamp)
+
+        early = next_block(self.chain[-1])
+        early.timestamp = mtp
+        self.assertIsNone(c.receiveBlock(early))
+        self.assertIn(early.id, c.invalidBlocks)
+
+        # A block from the future is dropped, but may come back later.
+        late = next_block(self.chain[-1])
+        late.timestamp = int(utils.now() * 1000) + 2 * blockchain.MAX_FUTURE_BLOCK_TIME
+        self.assertIsNone(c.receiveBlock(late))
+        self.assertNotIn(late.id, c.invalidBlocks)
+        with mock.patch.object(utils, "now", return_value=late.timestamp / 1000):
+            self.assertEqual(c.receiveBlock(late).id, late.id)
+
+    def test_unlinked_headers_drop_peer(self):
+        net = mock.Mock()
+        late = client.Client(name="Late", net=net, startingBlock=self.chain[0], keyPair={'public': 'Late'})
+        late.syncPeers = ['a', 'b']
+        late.receiveHeaders(codec.encodeHeaders([self.chain[2].header]))
+        self.assertEqual(late.syncPeers, ['b'])
+        self.assertEqual(late.syncHeaders, [])
+        self.assertEqual(net.send_message.call_args[0][:2], ('b', blockchain.GET_HEADERS))
+
+    def test_malformed_headers_drop_peer(self):
+        net = mock.Mock()
+        late = client.Client(name="Late", net=net, startingBlock=self.chain[0], keyPair={'public': 'Late'})
+        late.syncPeers = ['a', 'b']
+        late.receiveHeaders(codec.encodeHeaders([self.chain[1].header])[:-1])
+        self.assertEqual(late.syncPeers, ['b'])
+        self.assertEqual(net.send_message.call_args[0][:2], ('b', blockchain.GET_HEADERS))
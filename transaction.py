@@ -1,8 +1,31 @@
-from utils import hashe, sign, addressMatchesKey, verifySignature
+from functools import lru_cache
+import hashlib
+from types import MappingProxyType
+
+from utils import HASH_ALG, LRUCache, sign, addressMatchesKey, verifySignature
 
 # String constants mixed in before hashing.
 TX_CONST = "TX"
 
+# Fields that determine a transaction's ID.  They cannot be changed after
+# construction, so the cached payload and ID never go stale.
+ID_FIELDS = frozenset(['from_address', 'nonce', 'pub_key', 'outputs', 'fee', 'data'])
+
+# The hash constructor itself: hashlib.new looks the algorithm up on every call.
+_new_hash = getattr(hashlib, HASH_ALG)
+
+# Reprs of public keys, which are long and shared by every transaction from
+# the same account.
+_key_repr = lru_cache(maxsize=1024)(repr)
+
+# Signatures this process has already verified, keyed by (tx id, signature),
+# so re-running blocks and rebuilding block templates never re-verify them.
+SIG_CACHE_SIZE = 100000
+verified_signatures = LRUCache(SIG_CACHE_SIZE)
+
+# Number of signatures sent to a worker process at a time.
+VERIFY_CHUNK_SIZE = 64
+
 
 class Transaction:
     """
@@ -13,32 +36,74 @@ class Transaction:
     has been used.)
     """
 
-    def __init__(self, from_address, nonce, pub_key, sig=None, outputs=None, fee=0, data={}):
-        self.from_address = from_address
-        self.nonce = nonce
-        self.pub_key = pub_key
-        self.sig = sig
-        self.fee = fee
-        self.outputs = []
-        if outputs:
-            for output in outputs:
-                amount = int(output['amount']) if not isinstance(output['amount'], int) else output['amount']
-                self.outputs.append({'amount': amount, 'address': output['address']})
-        self.data = data
+    def __init__(self, from_address, nonce, pub_key, sig=None, outputs=None, fee=0, data=None):
+        frozen_outputs = tuple(
+            MappingProxyType({'amount': output['amount'] if isinstance(output['amount'], int) else int(output['amount']),
+                              'address': output['address']})
+            for output in outputs or ())
+        # Set in one go rather than through __setattr__, which only has to
+        # guard the ID fields once they exist.  Blocks decode many of these.
+        self.__dict__.update(from_address=from_address, nonce=nonce, pub_key=pub_key, sig=sig, fee=fee,
+                             outputs=frozen_outputs, data=MappingProxyType(dict(data or {})),
+                             _payload=None, _id=None)
+
+    def __setattr__(self, name, value):
+        if name in ID_FIELDS and name in self.__dict__:
+            raise AttributeError(f"Transaction field '{name}' cannot be changed.")
+        super().__setattr__(name, value)
+
+    def __eq__(self, other):
+        return isinstance(other, Transaction) and self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    @property
+    def payload(self):
+        """
+        The canonical bytes that the ID is derived from, computed once.
+        """
+        if self._payload is None:
+            # Spelled out, this is the repr of a dict of these fields, but
+            # it does not build the dict (and a dict per output) first.
+            outputs = ", ".join([f"{{'amount': {output['amount']!r}, 'address': {output['address']!r}}}"
+                                 for output in self.outputs])
+            self._payload = (f"{TX_CONST}{{'from': {self.from_address!r}, 'nonce': {self.nonce!r}, "
+                             f"'pubKey': {_key_repr(self.pub_key)}, 'outputs': [{outputs}], 'fee': {self.fee!r}, "
+                             f"'data': {dict(self.data)!r}}}").encode()
+        return self._payload
 
     @property
     def id(self):
         """
         A transaction's ID is derived from its contents.
         """
-        return hashe(TX_CONST + str({
+        if self._id is None:
+            self._id = _new_hash(self.payload).hexdigest()
+        return self._id
+
+    def toJSON(self):
+        return {
             'from': self.from_address,
             'nonce': self.nonce,
-            'pubKey': self.pub_key,
-            'outputs': self.outputs,
+            'pubKey': self.pub_key.decode() if isinstance(self.pub_key, bytes) else self.pub_key,
+            'sig': self.sig.hex() if isinstance(self.sig, bytes) else self.sig,
+            'outputs': [dict(output) for output in self.outputs],
             'fee': self.fee,
-            'data': self.data
-        }))
+            'data': dict(self.data),
+        }
+
+    @staticmethod
+    def deserialize(o):
+        """
+        Rebuilds a transaction from the output of toJSON.
+        """
+        if isinstance(o, Transaction):
+            return o
+        pub_key = o['pubKey'].encode() if isinstance(o['pubKey'], str) else o['pubKey']
+        sig = bytes.fromhex(o['sig']) if isinstance(o['sig'], str) else o['sig']
+        return Transaction(o['from'], o['nonce'], pub_key, sig=sig, outputs=o['outputs'], fee=o['fee'],
+                           data=o['data'])
 
     def sign(self, priv_key):
         """
@@ -55,8 +120,16 @@ class Transaction:
 
         :return: Validity of the signature and from address.
         """
-        return self.sig is not None and addressMatchesKey(self.from_address, self.pub_key) and verifySignature(
+        if self.sig is None:
+            return False
+        key = (self.id, self.sig)
+        if verified_signatures.get(key):
+            return True
+        valid = addressMatchesKey(self.from_address, self.pub_key) and verifySignature(
             self.pub_key, self.id, self.sig)
+        if valid:
+            verified_signatures.put(key, True)
+        return valid
 
     def sufficient_funds(self, block):
         """
@@ -65,7 +138,7 @@ class Transaction:
         :param block: Block used to check current balances
         :return: True if there are sufficient funds for the transaction, according to the balances from the specified block.
         """
-        return self.total_output() <= block.balances.get(self.from_address)
+        return self.total_output() <= block.balances.get(self.from_address, 0)
 
     def total_output(self):
         """
@@ -74,3 +147,43 @@ class Transaction:
         :return: Total amount of gold given out with this transaction.
         """
         return sum([output['amount'] for output in self.outputs]) + self.fee
+
+
+def _verify(args):
+    from_address, pub_key, tx_id, sig = args
+    return addressMatchesKey(from_address, pub_key) and verifySignature(pub_key, tx_id, sig)
+
+
+def verify_signatures(txs, executor=None):
+    """
+    Verifies the signatures of many transactions at once, skipping any that
+    are already known to be valid.  RSA verification holds the GIL, so pass
+    a ProcessPoolExecutor to spread the work over several cores.
+
+    Valid signatures are recorded in the signature cache, so a later call to
+    valid_signature for the same transaction is only a lookup.
+
+    :param txs: Transactions to verify.
+    :param executor: Optional executor to run the verifications on.
+    :return: True if every transaction has a valid signature.
+    """
+    all_valid = True
+    pending = []
+    for tx in txs:
+        if tx.sig is None:
+            all_valid = False
+        elif not verified_signatures.get((tx.id, tx.sig)):
+            pending.append(tx)
+
+    args = [(tx.from_address, tx.pub_key, tx.id, tx.sig) for tx in pending]
+    if executor is None:
+        results = map(_verify, args)
+    else:
+        results = executor.map(_verify, args, chunksize=VERIFY_CHUNK_SIZE)
+
+    for tx, valid in zip(pending, results):
+        if valid:
+            verified_signatures.put((tx.id, tx.sig), True)
+        else:
+            all_valid = False
+    return all_valid
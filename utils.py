@@ -1,10 +1,143 @@
+from collections import OrderedDict
 import hashlib
+import heapq
+from threading import Lock
+import time
+
+from Crypto.Hash import SHA256
 from Crypto.PublicKey import RSA
+from Crypto.Signature import pkcs1_15
 
 # CRYPTO settings
 HASH_ALG = 'sha256'
 SIG_ALG = 'RSA-SHA256'
 
+# Maximum number of parsed keys (and key addresses) kept in memory.
+KEY_CACHE_SIZE = 1024
+
+# Source of the current time, in seconds.  Simulations can install a virtual
+# clock with setClock, so block timestamps follow simulated time.
+_clock = time.time
+
+
+def now() -> float:
+    return _clock()
+
+
+def setClock(clock=None):
+    """
+    :param clock: function returning the time in seconds, or None to go back
+        to the system clock.
+    """
+    global _clock
+    _clock = time.time if clock is None else clock
+
+
+class LRUCache:
+    """
+    A bounded, thread-safe map that evicts the least recently used entry
+    and counts hits and misses.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def getOrCompute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute(key)
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class LazyHeap:
+    """
+    A min-heap of items by key, over the items of a live collection.  Items
+    dropped from the collection are not searched for in the heap; their
+    entries are skipped when they reach the top, and the heap is rebuilt
+    once stale entries outnumber live ones.  Among equal keys, the item
+    pushed first comes first.
+    """
+
+    def __init__(self, live):
+        """
+        :param live: collection holding the items that are still wanted,
+            e.g. a dict keyed by item or a set.
+        """
+        self.live = live
+        self._entries = []
+        self._seq = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def push(self, key, item):
+        heapq.heappush(self._entries, (key, self._seq, item))
+        self._seq += 1
+
+    def peek(self):
+        """
+        Returns the live item with the smallest key, or None.
+        """
+        while self._entries and self._entries[0][2] not in self.live:
+            heapq.heappop(self._entries)
+        return self._entries[0][2] if self._entries else None
+
+    def pop(self):
+        """
+        Removes and returns the live item with the smallest key, or None.
+        """
+        item = self.peek()
+        if item is not None:
+            heapq.heappop(self._entries)
+        return item
+
+    def compact(self):
+        """
+        Drops stale entries if they make up most of the heap.
+        """
+        if len(self._entries) > 2 * len(self.live) + 16:
+            self._entries = [e for e in self._entries if e[2] in self.live]
+            heapq.heapify(self._entries)
+
+
+# Parsed RSA keys keyed by their PEM bytes, and addresses keyed by public key.
+keyCache = LRUCache(KEY_CACHE_SIZE)
+addressCache = LRUCache(KEY_CACHE_SIZE)
+
 
 def hashe(s, encoding='hex'):
     return hashlib.new(HASH_ALG, s.encode()).hexdigest()
@@ -18,23 +151,39 @@ def generateKeypair():
     }
 
 
+def importKey(pem):
+    """
+    Parses a PEM key, reusing the parsed object for keys seen before.
+    """
+    return keyCache.getOrCompute(pem, RSA.import_key)
+
+
 def sign(privKey, msg):
-    signer = RSA.import_key(privKey)
+    signer = pkcs1_15.new(importKey(privKey))
     string = (msg if isinstance(msg, str) else str(msg))
-    return signer.sign(string.encode(), '')
+    return signer.sign(SHA256.new(string.encode()))
 
 
 def verifySignature(pubKey, msg, sig):
-    verifier = RSA.import_key(pubKey)
     string = (msg if isinstance(msg, str) else str(msg))
-    return verifier.verify(string.encode(), sig)
+    try:
+        # The key comes off the wire too, so a malformed one is just a bad
+        # signature.
+        verifier = pkcs1_15.new(importKey(pubKey))
+        verifier.verify(SHA256.new(string.encode()), sig)
+    except (ValueError, TypeError):
+        return False
+    return True
 
 
 def calcAddress(key):
+    # PEM keys may arrive as bytes or str; both give the same address.
+    if isinstance(key, bytes):
+        key = key.decode()
     addr = hashe(str(key), 'base64')
     # print(f"Generating address {addr} from {key}")
     return addr
 
 
 def addressMatchesKey(addr, pubKey):
-    return addr == calcAddress(pubKey.decode())
+    return addr == addressCache.getOrCompute(pubKey, calcAddress)